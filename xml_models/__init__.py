@@ -1,2 +1,3 @@
 from xml_models import *
-import xpath_twister
\ No newline at end of file
+from cache import BaseCache, LocMemCache, FileCache, DjangoCache
+import xpath_twister
@@ -0,0 +1,206 @@
+"""
+Copyright 2009 Chris Tarttelin and Point2 Technologies
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+Redistributions in binary form must reproduce the above copyright notice, this list
+of conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE FREEBSD PROJECT ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of the FreeBSD Project.
+"""
+
+__doc__="""Caches that XmlModelQuery consults before calling the REST service.  A model opts in by declaring a
+cache_backend next to its finders, and may also declare a cache_timeout in seconds and a cache_prefix for its
+keys.  For example:
+
+class Address(xml_models.Model):
+    city = xml_models.CharField(xpath='/address/city')
+
+    finders = { (city,): "http://localhost/address/%s" }
+    cache_backend = xml_models.LocMemCache(max_entries=500)
+    cache_timeout = 600
+
+Any object with the BaseCache methods and a dump_collections attribute will do as a backend."""
+
+import os, time, tempfile, hashlib, cPickle
+from xpath.cache import LRUCache
+
+
+class BaseCache(object):
+    """Timeouts are in seconds.  A timeout of None means the backend's default_timeout, and a default_timeout of
+    None means values never expire.
+
+    get() caches the response it built its model from, but the results of iterating a query are only cached
+    when dump_collections is true, because dumping each model as it is yielded parses every one of its fields at
+    once rather than when they are first read."""
+    def __init__(self, default_timeout=300, dump_collections=False):
+        self.default_timeout = default_timeout
+        self.dump_collections = dump_collections
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        "Returns a dict of the keys that were found, mapped to their values"
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+_MISSING = object()
+
+class LocMemCache(BaseCache):
+    """An in-process cache holding at most max_entries values.  When it is full, the least recently used value
+    is discarded to make room.  Values are stored as they are, not copied."""
+    def __init__(self, max_entries=1000, default_timeout=300, dump_collections=False):
+        BaseCache.__init__(self, default_timeout, dump_collections)
+        # Entries are (value, expires) pairs.
+        self._entries = LRUCache(max_entries)
+
+    @property
+    def max_entries(self):
+        return self._entries.maxsize
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if _expired(expires, time.time()):
+            self._entries.delete(key)
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        self._entries.put(key, (value, self._expires(timeout)))
+
+    def delete(self, key):
+        self._entries.delete(key)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        now = time.time()
+        return len([key for key, (value, expires) in self._entries.items() if not _expired(expires, now)])
+
+class FileCache(BaseCache):
+    """Stores each value as a pickle in a file of its own under directory, so the cache survives restarts and
+    can be shared by processes on the same machine.  Files are replaced atomically, so concurrent readers
+    never see a partly written value."""
+    def __init__(self, directory, default_timeout=300, dump_collections=False):
+        BaseCache.__init__(self, default_timeout, dump_collections)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, default=None):
+        try:
+            cache_file = open(self._path(key), 'rb')
+        except IOError:
+            return default
+        try:
+            try:
+                expires, value = cPickle.load(cache_file)
+            except (EOFError, ValueError, cPickle.UnpicklingError):
+                return default
+        finally:
+            cache_file.close()
+        if _expired(expires, time.time()):
+            self.delete(key)
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            temp_file = os.fdopen(handle, 'wb')
+            try:
+                cPickle.dump((self._expires(timeout), value), temp_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                temp_file.close()
+            os.rename(temp_path, self._path(key))
+        except:
+            os.remove(temp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, _hash(key))
+
+class DjangoCache(BaseCache):
+    """Adapts a Django cache, django.core.cache.cache unless another is supplied.  Keys are hashed so that
+    they are safe to use with memcached.  A timeout of None leaves the expiry to Django's own default."""
+    def __init__(self, cache=None, default_timeout=None, dump_collections=False):
+        BaseCache.__init__(self, default_timeout, dump_collections)
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+
+    def get(self, key, default=None):
+        return self.cache.get(_hash(key), default)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout is None:
+            self.cache.set(_hash(key), value)
+        else:
+            self.cache.set(_hash(key), value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(_hash(key))
+
+    def get_many(self, keys):
+        hashed = dict([(_hash(key), key) for key in keys])
+        found = self.cache.get_many(hashed.keys())
+        return dict([(hashed[key], value) for key, value in found.items()])
+
+def _expired(expires, now):
+    return expires is not None and expires < now
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.md5(key).hexdigest()
@@ -31,7 +31,7 @@ to xml, and specifying finders that map to a remote REST service.  For parsing X
 XPath expressions, xml_models attempts to use lxml if it is available.  If not, it 
 uses pyxml_xpath.  Better performance will be gained by installing lxml."""
 
-import unittest, re, datetime, time
+import unittest, re, datetime, time, sys, types, threading, hashlib, cPickle
 import xpath_twister as xpath
 from xml.etree import ElementTree as et
 import rest_client
@@ -48,40 +48,82 @@ class DoesNotExist(Exception):
 class XmlValidationError(Exception):
     pass
 
+class SchemaMismatchError(Exception):
+    pass
+
+_UNPARSED = object()
+
+KEEP_ALL = 'keep_all'
+DROP_XML = 'drop_xml'
+DROP_ALL = 'drop_all'
+
 class BaseField:
     """All fields must specify an xpath as a keyword arg in their constructor.  Fields may optionally specify a 
-    default value using the default keyword arg."""
+    default value using the default keyword arg, and values for the variables in their xpath using the variables
+    keyword arg, e.g. CharField(xpath="/root/name[@lang=$lang]", variables={'lang': 'en'}).  Fields whose xpaths
+    only differ in those values then share one compiled expression."""
     def __init__(self, **kw):
         if not kw.has_key('xpath'):
             raise Exception('No XPath supplied for xml field')
         self.xpath = kw['xpath']
         self._default = kw.pop('default', None)
+        self.variables = kw.pop('variables', None)
             
     
     def _fetch_by_xpath(self, xml_doc, namespace):
-        find = xpath.find_unique(xml_doc, self.xpath, namespace)
+        find = xpath.find_unique(xml_doc, self.xpath, namespace, self.variables)
         if find == None:
             return self._default
         return find
 
-    
-    def _parse(self, xml, namespace):
-        try:
-            return self.__cached_value
-        except:
-            self.__cached_value = self.parse(xml, namespace)
-            return self.__cached_value
+    def parse(self, xml, namespace):
+        return self.to_python(self._fetch_by_xpath(xml, namespace))
+
+    def to_python(self, value):
+        "Converts the value found by the xpath expression, or the default, into the value of the field"
+        return value
+
+    def _from_stream(self, matches, namespace):
+        "Returns the value of the field from the matches of a StreamMatcher, rather than from a document"
+        if len(matches) > 1:
+            raise xpath.MultipleNodesReturnedException
+        value = None
+        if matches:
+            value = xpath.match_text(matches[0])
+        if value is None:
+            value = self._default
+        return self.to_python(value)
+
+    def _dump(self, value):
+        return value
+
+    def _load(self, value):
+        return value
+
+    def _schema(self):
+        "Describes everything about the field that affects its parsed value, for versioning serialized models"
+        default = self._default
+        if not isinstance(default, (basestring, int, long, float, type(None))):
+            # The repr of other objects may include their address, which changes from run to run.
+            default = type(default).__name__
+        variables = self.variables and sorted(self.variables.items())
+        attrs = [self.xpath, self.__dict__.get('order_by'), self.__dict__.get('date_format'), variables, default]
+        schema = '%s%r' % (self.__class__.__name__, attrs)
+        field_type = self.__dict__.get('field_type')
+        if isinstance(field_type, ModelBase):
+            schema += field_type._schema_version()
+        elif field_type is not None:
+            schema += field_type.__name__
+        return schema
+
     
 class CharField(BaseField):
     """Returns the single value found by the xpath expression, as a string"""
-    def parse(self, xml, namespace):
-        return self._fetch_by_xpath(xml, namespace)
         
 
 class IntField(BaseField):
     """Returns the single value found by the xpath expression, as an int"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
             return int(value)
         return self._default
@@ -101,8 +143,7 @@ class DateField(BaseField):
         BaseField.__init__(self,**kw)
         self.date_format = date_format
         
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
             utc_stripped = self.match_utcoffset.findall(value)
             if len(utc_stripped) == 1:
@@ -134,16 +175,14 @@ class DateField(BaseField):
         
 class FloatField(BaseField):
     """Returns the single value found by the xpath expression, as a float"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
             return float(value)
         return self._default
 
 class BoolField(BaseField):
     """Returns the single value found by the xpath expression, as a boolean"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value is not None:
             if value.lower() == 'true':
                 return True
@@ -161,7 +200,7 @@ class Collection(BaseField):
         BaseField.__init__(self,**kw)
         
     def parse(self, xml, namespace):
-        matches = xpath.find_all(xml, self.xpath, namespace)
+        matches = xpath.find_all(xml, self.xpath, namespace, self.variables)
 
         if not BaseField in self.field_type.__bases__:
             
@@ -169,9 +208,30 @@ class Collection(BaseField):
         else:
             field = self.field_type(xpath = '.')
             results = [field.parse(xpath.domify(match), namespace) for match in matches]
+        return self._ordered(results)
+
+    def _from_stream(self, matches, namespace):
+        if not BaseField in self.field_type.__bases__:
+            results = [_from_element(self.field_type, match) for match in matches]
+        else:
+            field = self.field_type(xpath = '.')
+            results = [field._from_stream([match], namespace) for match in matches]
+        return self._ordered(results)
+
+    def _ordered(self, results):
         if self.order_by:
             results.sort(lambda a,b : cmp(getattr(a, self.order_by), getattr(b, self.order_by)))
         return results
+
+    def _dump(self, values):
+        if isinstance(self.field_type, ModelBase):
+            return [value._dump() for value in values]
+        return values
+
+    def _load(self, values):
+        if isinstance(self.field_type, ModelBase):
+            return [self.field_type._load(value) for value in values]
+        return values
     
 CollectionField = Collection
 
@@ -181,18 +241,47 @@ class OneToOneField(BaseField):
         BaseField.__init__(self,**kw)
         
     def parse(self, xml, namespace):
-        match = xpath.find_all(xml, self.xpath, namespace)
+        match = xpath.find_all(xml, self.xpath, namespace, self.variables)
         if len(match) == 1:
             return self.field_type(xml=match[0])
         return None
+
+    def _from_stream(self, matches, namespace):
+        if len(matches) == 1:
+            return _from_element(self.field_type, matches[0])
+        return None
+
+    def _dump(self, value):
+        if value is not None:
+            return value._dump()
+
+    def _load(self, value):
+        if value is not None:
+            return self.field_type._load(value)
         
 class ModelBase(type):
     "Meta class for declarative xml_model building"
+    def __new__(meta, name, bases, attrs):
+        compact = attrs.get('compact', True in [getattr(base, 'compact', False) for base in bases])
+        if compact and not attrs.has_key('__slots__'):
+            attrs['__slots__'] = ()
+        return type.__new__(meta, name, bases, attrs)
+
     def __init__(cls, name, bases, attrs):
         xml_fields = [field_name for field_name in attrs.keys() if isinstance(attrs[field_name], BaseField)]
+        xml_fields.sort()
+        fields = list(getattr(cls, '_fields', []))
+        ordinals = dict([(field._name, field._ordinal) for field in fields])
         for field_name in xml_fields:
-            setattr(cls, field_name, cls._get_xpath(field_name, attrs[field_name]))
-            attrs[field_name]._name = field_name
+            field = attrs[field_name]
+            setattr(cls, field_name, cls._get_xpath(field_name, field))
+            field._name = field_name
+            field._ordinal = ordinals.get(field_name, len(fields))
+            if field._ordinal == len(fields):
+                fields.append(field)
+            else:
+                fields[field._ordinal] = field
+        cls._fields = fields
         if attrs.has_key("finders"):
             setattr(cls, "objects", XmlModelManager(cls, attrs["finders"]))
     
@@ -236,16 +325,36 @@ class XmlModelQuery(object):
         return self
 
     def count(self):
+        cached = self._cache_get('all')
+        if cached is not None:
+            return len(cached)
         response = rest_client.Client("").GET(self._find_query_path()) 
         count = 0
-        for x in self._fragments(response.content):
+        for elem in self._elements(response.content):
             count += 1
         return count
         
     def __iter__(self):
+        cached = self._cache_get('all')
+        if cached is not None:
+            for model in cached:
+                yield model
+            return
         response = rest_client.Client("").GET(self._find_query_path()) 
-        for x in self._fragments(response.content):
-            yield self.model(xml=x)
+        if self.model.stream:
+            models = self._streamed(response.content)
+        else:
+            models = (_from_element(self.model, elem) for elem in self._elements(response.content))
+        backend = self._cache_backend()
+        if backend is None or not backend.dump_collections:
+            for model in models:
+                yield model
+            return
+        dumped = []
+        for model in models:
+            dumped.append(model.dumps())
+            yield model
+        self._cache_set('all', dumped)
             
     def __len__(self):
         return self.count()
@@ -253,6 +362,12 @@ class XmlModelQuery(object):
     def get(self, **kw):
         for key in kw.keys():
             self.args[key] = kw[key]
+        backend = self._cache_backend()
+        if backend is not None:
+            # The response is cached rather than the model, so that its fields are still parsed lazily.
+            content = backend.get(self._cache_key('xml'))
+            if content is not None:
+                return self.model(xml=content)
         response = rest_client.Client("").GET(self._find_query_path())
         if not response.content:
             raise DoesNotExist(self.model, self.args)
@@ -261,18 +376,77 @@ class XmlModelQuery(object):
         content = response.content.read()
         if not content:
             raise DoesNotExist(self.model, self.args)
-        return self.model(xml=content)
-        
-    def _fragments(self, xml):
+        model = self.model(xml=content)
+        self._cache_set('xml', content)
+        return model
+
+    def _cache_backend(self):
+        return getattr(self.model, 'cache_backend', None)
+
+    def _cache_key(self, kind):
+        prefix = getattr(self.model, 'cache_prefix', None) or '%s.%s' % (self.model.__module__, self.model.__name__)
+        return '%s:%s:%s' % (prefix, kind, self._find_query_path())
+
+    def _cache_get(self, kind):
+        "Returns the list of models cached for this query, or None if there are none cached under the current schema"
+        backend = self._cache_backend()
+        if backend is None:
+            return None
+        dumped = backend.get(self._cache_key(kind))
+        if dumped is None:
+            return None
+        try:
+            return [self.model.loads(data) for data in dumped]
+        except SchemaMismatchError:
+            return None
+
+    def _cache_set(self, kind, value):
+        backend = self._cache_backend()
+        if backend is not None:
+            backend.set(self._cache_key(kind), value, getattr(self.model, 'cache_timeout', None))
+
+    def _elements(self, xml):
+        "Yields each fragment of the response as an ElementTree element, which is dropped from the tree once the caller moves on"
         tree = et.iterparse(xml, ['start','end'])
-        tree.next()
+        evt, root = tree.next()
         evt, child = tree.next()
         node_name = child.tag
+        open_elements = [root, child]
         for event, elem in tree:
-            if event == 'end' and elem.tag == node_name:
-                result = et.tostring(elem)
-                elem.clear()
-                yield result
+            if event == 'start':
+                open_elements.append(elem)
+                continue
+            open_elements.pop()
+            if elem.tag == node_name:
+                yield elem
+                if open_elements:
+                    # Detached rather than cleared, as the model may have adopted it as its document.
+                    open_elements[-1].remove(elem)
+
+    def _streamed(self, xml):
+        "Builds a model from each fragment, taking the field values from a StreamMatcher rather than a document"
+        matcher = self.model._stream_matcher()
+        node_name = None
+        matching = False
+        depth = 0
+        for event, elem in et.iterparse(xml, ['start','end']):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    if node_name is None:
+                        node_name = elem.tag
+                    matching = elem.tag == node_name
+                    matcher.reset()
+                if depth >= 2 and matching:
+                    matcher.start(elem)
+            else:
+                if depth >= 2 and matching:
+                    matcher.end(elem)
+                if depth == 2:
+                    if matching:
+                        yield self.model._from_stream(matcher.results())
+                    elem.clear()
+                depth -= 1
 
     def _find_query_path(self):
         keys = self.args.keys()
@@ -297,12 +471,35 @@ class Model:
         nicknames = xml_models.CollectionField(CharField, xpath="/Person/Nicknames/Name")
         addresses = xml_models.CollectionField(Address, xpath="/Person/Addresses/Address")
         date_of_birth = xml_models.DateField(xpath="/Person/@DateOfBirth", date_format="%d-%m-%Y")
+
+    Setting compact=True on a model stores the parsed values in a slot array indexed by field, rather than a
+    per-instance dict, and drops the xml and the document once every field has been parsed.  Compact models
+    can't have arbitrary attributes assigned to them.
+
+    The retention attribute controls how long the source of the values is kept.  KEEP_ALL (the default) keeps
+    both the xml string and the document, DROP_XML discards the xml string once it has been parsed into a
+    document, and DROP_ALL parses every field as soon as the model is loaded and then discards both.
+
+    Setting stream=True on a model makes query iteration read every field while the response is being parsed,
+    with a streaming matcher, instead of parsing each fragment into a document.  The field xpaths must then be
+    absolute paths using only child and descendant steps, with simple attribute predicates, in which the field's
+    variables stand for the literals they are bound to, and the values are converted as soon as the model is loaded.
+
+    dumps() serializes just the parsed values of a model, including nested models, and Model.loads() rebuilds
+    the model from them without parsing any xml, which makes models cheap to keep in memcached or on disk.
+    Pickling a model uses the same format.  Serialized models are stamped with a hash of the model's fields, and
+    loading one that was dumped from a different version of the model raises a SchemaMismatchError.
     """
+    __slots__ = ('_xml', '_dom', '_cache')
+    compact = False
+    retention = KEEP_ALL
+    stream = False
+
     def __init__(self, xml=None, dom=None):
-        self._xml = xml
-        self._dom = dom
-        self._cache = {}
+        self._reset(xml, dom)
         self.validate_on_load()
+        if self.retention == DROP_ALL:
+            self._materialize()
 
     """Override on your model to perform validation when the XML data is first passed in. This is to ensure the xml returned
        conforms to the validation rules.  We use this because some records are no use to us if they don't contain certain
@@ -310,26 +507,225 @@ class Model:
     def validate_on_load(self):
         pass
 
+    def memory_footprint(self):
+        """Returns the approximate number of bytes held by this model, broken down into the xml string, the
+        parsed document and the parsed field values (including any nested models), plus the total."""
+        return self._footprint(set())
+
+    def _footprint(self, seen):
+        seen.add(id(self))
+        footprint = {'xml': _sizeof(self._xml, seen), 'values': sys.getsizeof(self._cache)}
+        footprint['dom'] = xpath.native_size(self._dom) or _sizeof(self._dom, seen)
+        if self.compact:
+            values = self._cache
+        else:
+            values = self._cache.values()
+        for value in values:
+            if value is not _UNPARSED:
+                footprint['values'] += _sizeof(value, seen)
+        footprint['total'] = sys.getsizeof(self) + footprint['xml'] + footprint['dom'] + footprint['values']
+        return footprint
+
+    def dumps(self):
+        "Returns the parsed values of this model as a string, which Model.loads() turns back into a model"
+        return cPickle.dumps(self._dump(), cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        "Rebuilds a model from the output of dumps(), raising SchemaMismatchError if the model has changed since"
+        return cls._load(cPickle.loads(data))
+
+    def __reduce__(self):
+        return (_unpickle, (self.__class__, self._dump()))
+
+    def _dump(self):
+        self._materialize()
+        values = [field._dump(self._lookup(field)) for field in self._fields]
+        return (self._schema_version(), values)
+
+    @classmethod
+    def _load(cls, dumped):
+        version, values = dumped
+        if version != cls._schema_version():
+            raise SchemaMismatchError("%s was serialized with a different schema" % cls.__name__)
+        model = cls.__new__(cls)
+        model._reset(None, None)
+        for field, value in zip(cls._fields, values):
+            model._store(field, field._load(value))
+        return model
+
+    @classmethod
+    def _stream_matcher(cls):
+        expressions = dict([(field._name, field.xpath) for field in cls._fields])
+        variables = dict([(field._name, field.variables) for field in cls._fields if field.variables])
+        return xpath.stream_matcher(expressions, getattr(cls, 'namespace', None), variables)
+
+    @classmethod
+    def _from_stream(cls, matches):
+        "Builds a model from the matches of a StreamMatcher.  Every field is read from them, so no xml is kept"
+        namespace = getattr(cls, 'namespace', None)
+        model = cls.__new__(cls)
+        model._reset(None, None)
+        for field in cls._fields:
+            model._store(field, field._from_stream(matches.get(field._name, []), namespace))
+        model.validate_on_load()
+        return model
+
+    @classmethod
+    def _schema_version(cls):
+        if not cls.__dict__.has_key('_schema_hash'):
+            schema = [cls.__module__, cls.__name__, repr(getattr(cls, 'namespace', None))]
+            schema.extend([field._schema() for field in cls._fields])
+            cls._schema_hash = hashlib.md5('\n'.join(schema)).hexdigest()
+        return cls._schema_hash
+
+    def _reset(self, xml, dom):
+        self._xml = xml
+        self._dom = dom
+        if self.compact:
+            self._cache = [_UNPARSED] * len(self._fields)
+        else:
+            self._cache = {}
+
     def _get_xml(self):
-        if self._dom is None:
-            try :
-                self._dom = xpath.domify(self._xml)
-            except Exception, e:
-                print self._xml
-                print str(e)
-                raise e
-        return self._dom
+        dom = self._dom
+        if dom is None:
+            dom = _once(self, None, self._domify)
+        return dom
+
+    def _domify(self):
+        try :
+            return xpath.domify(self._xml)
+        except Exception, e:
+            print self._xml
+            print str(e)
+            raise e
         
     def _set_value(self, field, value):
-        self._cache[field] = value
+        _once(self, field, lambda: value, replace=True)
+
+    def _lookup(self, field):
+        if field is None:
+            if self._dom is None:
+                return _UNPARSED
+            return self._dom
+        if self.compact:
+            return self._cache[field._ordinal]
+        return self._cache.get(field, _UNPARSED)
+
+    def _store(self, field, value):
+        if field is None:
+            self._dom = value
+            if self.retention != KEEP_ALL:
+                self._xml = None
+            return
+        if self.compact:
+            self._cache[field._ordinal] = value
+        else:
+            self._cache[field] = value
+        if (self.compact or self.retention == DROP_ALL) and self._is_materialized():
+            self._xml = None
+            self._dom = None
+
+    def _is_materialized(self):
+        if self.compact:
+            for cached in self._cache:
+                if cached is _UNPARSED:
+                    return False
+            return True
+        return len(self._cache) == len(self._fields)
+
+    def _materialize(self):
+        for field in self._fields:
+            self._parse_field(field)
         
     def _parse_field(self, field):
-        if not self._cache.has_key(field):
+        value = self._lookup(field)
+        if value is _UNPARSED:
             namespace = None
             if hasattr(self, 'namespace'):
                 namespace = self.namespace
-            self._cache[field] = field.parse(self._get_xml(), namespace)
-        return self._cache[field]
+            value = _once(self, field, lambda: field.parse(self._get_xml(), namespace))
+        return value
 
+def warm_xpath_cache(cache_file=None):
+    """Parses the xpath of every field of every model defined so far, so that no request pays for parsing them,
+    and dumps the parsed expressions to cache_file if given.  Worker processes started with the environment
+    variable XPATH_CACHE_FILE naming that file load them at import time rather than parsing them again."""
+    expressions = []
+    pending = [Model]
+    while pending:
+        model = pending.pop()
+        pending.extend(model.__subclasses__())
+        expressions.extend([field.xpath for field in model._fields if field.xpath])
+    xpath.warm(expressions, cache_file)
 
+def _from_element(model, element):
+    "Builds a model from an ElementTree element, adopting the element as its document where that avoids reparsing"
+    dom = xpath.domify_element(element)
+    if dom is None:
+        return model(xml=et.tostring(element))
+    return model(dom=dom)
+
+def _unpickle(cls, dumped):
+    return cls._load(dumped)
+
+_stripes = [(threading.Lock(), {}) for i in xrange(32)]
+
+def _once(model, field, compute, replace=False):
+    """Computes and stores the value of a field (or of the document, when field is None) on a model, at most
+    once.  Threads that race on the same model and field wait for the first one to finish and then share its
+    value, unless replace is set, in which case they wait and then store their own value.  The striped locks
+    only guard this bookkeeping and are never held while a value is computed, so models nested inside each
+    other can be parsed from any number of threads without deadlocking."""
+    token = (id(model), field)
+    lock, in_flight = _stripes[hash(token) % len(_stripes)]
+    while True:
+        lock.acquire()
+        try:
+            value = model._lookup(field)
+            if value is not _UNPARSED and not replace:
+                return value
+            waiter = in_flight.get(token)
+            if waiter is None:
+                waiter = in_flight[token] = threading.Event()
+                break
+        finally:
+            lock.release()
+        waiter.wait()
+    try:
+        value = compute()
+        model._store(field, value)
+        return value
+    finally:
+        lock.acquire()
+        del in_flight[token]
+        lock.release()
+        waiter.set()
 
+def _sizeof(obj, seen):
+    """Approximate size in bytes of obj and the objects reachable from it, counting each object only once.
+    Fields are shared between instances so they aren't counted."""
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if obj is None or id(obj) in seen or isinstance(obj, BaseField):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, Model):
+            size += obj._footprint(seen)['total']
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, (type, types.ClassType)):
+            pending.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if slot != '__weakref__':
+                    pending.append(getattr(obj, slot, None))
+    return size
@@ -27,8 +27,19 @@ or implied, of the FreeBSD Project.
 """
 
 import unittest
+from itertools import islice
+from StringIO import StringIO
 from xml.dom import minidom
+from xml.etree import ElementTree as et
+try:
+    from xml.etree import cElementTree as cet
+except ImportError:
+    cet = et
 import xpath
+from xpath.cache import LRUCache
+import xpath.dom
+import xpath.etree
+import xpath.stream
 
 class MultipleNodesReturnedException(Exception):
     pass
@@ -40,24 +51,60 @@ try:
 except:
     pass
 
-def find_unique(xml, expression, namespace=None):
-    if lxml_available:
-        return _lxml_xpath(xml, expression, namespace)
+BACKENDS = ('lxml', 'etree', 'pure')
+if lxml_available:
+    backend = 'lxml'
+else:
+    backend = 'pure'
+
+def set_backend(name):
+    """Selects the implementation behind domify(), find_unique() and find_all():
+        'lxml'  - lxml's XPath, on objectify trees
+        'etree' - ElementTree's findall() on cElementTree trees, for the paths and predicates it supports, and the
+                  pure xpath package for everything else
+        'pure'  - the pure xpath package, on xpath.dom documents
+    Documents can only be searched by the backend that built them, so switch before loading any models."""
+    global backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown xpath backend %r, expected one of %s" % (name, ', '.join(BACKENDS)))
+    if name == 'lxml' and not lxml_available:
+        raise ImportError("lxml is not installed")
+    backend = name
+
+def find_unique(xml, expression, namespace=None, variables=None):
+    """Returns the text of the single node the expression selects, or None.  variables is a dictionary of values
+    for the $variables in the expression, which is compiled once however often their values change."""
+    if backend == 'lxml':
+        return _lxml_xpath(xml, expression, namespace, variables)
+    elif backend == 'etree':
+        return _etree_xpath(xml, expression, namespace, variables)
     else:
-        return _pydom_xpath(xml, expression, namespace)
+        return _pydom_xpath(xml, expression, namespace, variables)
     
-def find_all(xml, expression, namespace=None):
-    if lxml_available:
-        return _lxml_xpath_all(xml, expression, namespace)
+def find_all(xml, expression, namespace=None, variables=None):
+    if backend == 'lxml':
+        return _lxml_xpath_all(xml, expression, namespace, variables)
+    elif backend == 'etree':
+        return _etree_xpath_all(xml, expression, namespace, variables)
     else:
-        return _pydom_xpath_all(xml, expression, namespace)
-    
-def _lxml_xpath(xml_doc, expression, namespace):
+        return _pydom_xpath_all(xml, expression, namespace, variables)
+
+# Compiled lxml expressions, keyed by (expression, namespace).
+_lxml_cache = LRUCache(100)
+
+def _lxml_compiled(expression, namespace):
+    find = _lxml_cache.get((expression, namespace))
+    if find is None:
         if namespace:
             find = etree.XPath(get_xpath(expression, namespace), namespaces={'x': namespace})
         else:
             find = etree.XPath(get_xpath(expression, namespace))
-        matches = find(xml_doc)
+        _lxml_cache.put((expression, namespace), find)
+    return find
+    
+def _lxml_xpath(xml_doc, expression, namespace, variables=None):
+        find = _lxml_compiled(expression, namespace)
+        matches = find(xml_doc, **(variables or {}))
         if len(matches) == 1:
             matched = matches[0]
             if type(matched) == type(''):
@@ -72,34 +119,123 @@ def _lxml_xpath(xml_doc, expression, namespace):
         if len(matches) > 1:
             raise MultipleNodesReturnedException
     
-def _lxml_xpath_all(xml, expression, namespace):
-    if namespace:
-        find = etree.XPath(get_xpath(expression, namespace), namespaces={'x': namespace})
-    else:
-        find = etree.XPath(get_xpath(expression,namespace))
-    matches = find(xml)
+def _lxml_xpath_all(xml, expression, namespace, variables=None):
+    find = _lxml_compiled(expression, namespace)
+    matches = find(xml, **(variables or {}))
     return [etree.tostring(match) for match in matches]
 
 def domify(xml):
-    if lxml_available:
+    if backend == 'lxml':
         return objectify.fromstring(xml)
+    elif backend == 'etree':
+        return EtreeDocument.parse(xml)
     else:
-        return minidom.parseString(xml)
+        return xpath.dom.parseString(xml)
+
+def native_size(dom):
+    """Returns the approximate number of bytes held outside of python by a document from domify(), or None
+    when the document is an ordinary python object graph.  lxml keeps its trees in native memory, so the
+    serialized length is used as a lower bound."""
+    if lxml_available and isinstance(dom, etree._Element):
+        return len(etree.tostring(dom))
+    if isinstance(dom, EtreeDocument) and not isinstance(dom.root, et.Element):
+        return len(et.tostring(dom.root))
+    return None
+
+class EtreeDocument(object):
+    """A document of the etree backend: its root element, the namespaces declared on the root, and the xpath.dom
+    mirror of the tree which expressions findall() can't handle are evaluated against."""
+    __slots__ = ('root', 'namespaces', '_mirror')
+
+    def __init__(self, root, namespaces=None):
+        self.root = root
+        self.namespaces = namespaces or {}
+        self._mirror = None
+
+    @classmethod
+    def parse(cls, xml):
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        namespaces = {}
+        root = None
+        for event, value in cet.iterparse(StringIO(xml), ('start-ns', 'start')):
+            if root is None:
+                if event == 'start':
+                    root = value
+                else:
+                    namespaces[value[0] or None] = value[1]
+        return cls(root, namespaces)
+
+    def default_namespace(self, namespace):
+        return namespace or self.namespaces.get(None)
 
-def _pydom_xpath_all(xml, expression, namespace):
-    nodelist = xpath.find(expression, xml, default_namespace=namespace)
+    def prefixes(self):
+        return dict([(prefix, uri) for prefix, uri in self.namespaces.items() if prefix is not None])
+
+    def mirror(self):
+        if self._mirror is None:
+            self._mirror = xpath.etree.adapt(self.root, keep_elements=True)
+        return self._mirror
+
+def _etree_findall(doc, expression, namespace, variables=None):
+    """Returns the elements or attribute values selected by the expression, through findall() where possible.
+    Expressions with variables are left to the pure engine."""
+    namespace = doc.default_namespace(namespace)
+    findall = xpath.etree.compile_findall(expression, namespace, doc.prefixes())
+    if findall is not None:
+        return findall(doc.root)
+    nodes = xpath.find(expression, doc.mirror(), default_namespace=namespace, namespaces=doc.prefixes(),
+                       variables=variables)
+    return [xpath.etree.mirrored(node) for node in nodes]
+
+def _etree_xpath(doc, expression, namespace, variables=None):
+    matches = _etree_findall(doc, expression, namespace, variables)
+    if len(matches) > 1:
+        raise MultipleNodesReturnedException
+    if len(matches) == 0:
+        return None
+    if isinstance(matches[0], xpath.dom.Node):
+        # Something other than an element or attribute value, from the pure engine.
+        return _pydom_value(matches[0])
+    return match_text(matches[0])
+
+def _etree_xpath_all(doc, expression, namespace, variables=None):
+    return [_etree_tostring(match) for match in _etree_findall(doc, expression, namespace, variables)]
+
+def _etree_tostring(match):
+    if isinstance(match, basestring):
+        return match
+    if isinstance(match, xpath.dom.Node):
+        return match.toxml()
+    # Serialize the element alone, without the text that follows it.
+    tail = match.tail
+    match.tail = None
+    try:
+        return et.tostring(match)
+    finally:
+        match.tail = tail
+
+def _pydom_xpath_all(xml, expression, namespace, variables=None):
+    nodelist = xpath.find(expression, xml, default_namespace=namespace, variables=variables)
     return [fragment.toxml() for fragment in nodelist]
 
-def _pydom_xpath(xml, expression, namespace):
-    nodelist = xpath.find(expression, xml, default_namespace=namespace)
+def _pydom_xpath(xml, expression, namespace, variables=None):
+    # Two matches are enough to know the result isn't unique.
+    nodelist = list(islice(xpath.iterfind(expression, xml, default_namespace=namespace, variables=variables), 2))
     if len(nodelist) > 1:
         raise MultipleNodesReturnedException
     if len(nodelist) == 0:
         return None
-    if nodelist[0].nodeType == minidom.Node.DOCUMENT_NODE:
-        node = nodelist[0].firstChild.firstChild
+    return _pydom_value(nodelist[0])
+
+def _pydom_value(match):
+    if match.nodeType == minidom.Node.ATTRIBUTE_NODE:
+        # xpath.dom attributes hold their value directly, not in a child text node as minidom's do.
+        return match.value
+    if match.nodeType == minidom.Node.DOCUMENT_NODE:
+        node = match.firstChild.firstChild
     else:
-        node = nodelist[0].firstChild
+        node = match.firstChild
     if node == None:
         return None
     if node.nodeType == minidom.Node.TEXT_NODE:
@@ -107,6 +243,42 @@ def _pydom_xpath(xml, expression, namespace):
     else:
         return None
             
+def stream_matcher(expressions, namespace=None, variables=None):
+    """Returns an xpath.stream.StreamMatcher for a dictionary of expressions, raising XPathNotImplementedError
+    if any of them can't be streamed.  variables maps the names of expressions to dictionaries of values for
+    their $variables, which are matched as the literals they are bound to."""
+    return xpath.stream.StreamMatcher(expressions, default_namespace=namespace, variables=variables)
+
+def match_text(match):
+    "Returns what find_unique would for a matching ElementTree element or attribute value, as from a StreamMatcher"
+    if isinstance(match, basestring):
+        return match
+    if match.text:
+        return unicode(match.text)
+    return None
+
+def domify_element(element):
+    """Returns a document for an ElementTree element, as domify() would for its xml but without serializing and
+    reparsing it, or None when documents come from lxml, which can't adopt the element."""
+    if backend == 'lxml':
+        return None
+    elif backend == 'etree':
+        return EtreeDocument(element)
+    return xpath.etree.adapt(element)
+
+def warm(expressions, cache_file=None):
+    """Parses expressions into the pure xpath package's expression cache, which the etree and pure backends
+    evaluate through and which grows to hold them all, and then dumps the cache to cache_file, if given, for
+    xpath.XPath.load_cache() or the XPATH_CACHE_FILE environment variable to load in other processes.
+    Expressions the package can't parse, such as some that only lxml supports, are skipped."""
+    for expression in expressions:
+        try:
+            xpath.XPath.warm([expression])
+        except xpath.XPathError:
+            pass
+    if cache_file is not None:
+        xpath.XPath.dump_cache(cache_file)
+
 def get_xpath(xpath, namespace):
     if namespace:
         xpath_list = xpath.split('/')
@@ -26,7 +26,7 @@ authors and should not be interpreted as representing official policies, either
 or implied, of the FreeBSD Project.
 """
 
-import unittest
+import unittest, os, sys, time, threading, pickle, tempfile, shutil
 from xml_models import *
 import xml_models.xpath_twister as xpath
 import rest_client
@@ -101,7 +101,13 @@ class XmlModelsTest(unittest.TestCase):
     def test_can_retrieve_attribute_value_from_xml_model(self):
         my_model = MyModel('<root><kiddie><value>Rowlf</value></kiddie></root>')
         self.assertEquals('Rowlf', my_model.muppet_name)
-        
+
+    def test_char_field_returns_xpathed_xml_attribute_value(self):
+        xml = xpath.domify('<root><kiddie name="Rowlf" age="7"/></root>')
+        self.assertEquals('Rowlf', CharField(xpath='/root/kiddie/@name').parse(xml, None))
+        self.assertEquals(7, IntField(xpath='/root/kiddie/@age').parse(xml, None))
+        self.assertEquals(None, CharField(xpath='/root/kiddie/@type').parse(xml, None))
+
     def test_returns_none_if_non_required_attribute_not_in_xml_and_no_default(self):
         my_model = MyModel('<root><kiddie><valuefoo>Rolf</valuefoo></kiddie></root>')
         self.assertEquals(None, my_model.muppet_name)
@@ -271,6 +277,320 @@ class XmlModelsTest(unittest.TestCase):
         qry = Simple.objects.filter(field1="baz")
         self.assertEquals(2, len(qry))
     
+    @patch_object(rest_client.Client, "GET")
+    def test_streamed_model_is_loaded_without_a_document(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><kiddie><value>Rowlf</value><age>7</age><age>8</age>"
+                               "<address><number>2</number></address><address><number>1</number></address></kiddie></root>"
+                               "<root><kiddie><value>Gonzo</value><type>whatever</type></kiddie></root></elems>")
+        mock_get.return_value = t()
+        results = [mod for mod in StreamedModel.objects.filter(muppet_name="baz")]
+        self.assertEquals(["Rowlf", "Gonzo"], [mod.muppet_name for mod in results])
+        self.assertEquals(["frog", "whatever"], [mod.muppet_type for mod in results])
+        self.assertEquals([[7, 8], []], [mod.muppet_ages for mod in results])
+        self.assertEquals([1, 2], [address.number for address in results[0].muppet_addresses])
+        self.assertEquals([None, None], [mod._dom for mod in results])
+        self.assertEquals([None, None], [mod._xml for mod in results])
+
+    @patch_object(rest_client.Client, "GET")
+    def test_streamed_model_uses_model_namespace(self, mock_get):
+        class t:
+            content = StringIO('<elems><root xmlns="urn:test:namespace"><name>Fozzie</name><age>3</age></root></elems>')
+        mock_get.return_value = t()
+        results = [mod for mod in StreamedNsModel.objects.filter(name="baz")]
+        self.assertEquals(["Fozzie"], [mod.name for mod in results])
+        self.assertEquals([3], [mod.age for mod in results])
+
+    @patch_object(rest_client.Client, "GET")
+    def test_streamed_model_skips_fragments_with_another_tag(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><kiddie><value>Rowlf</value></kiddie></root>"
+                               "<meta><kiddie><value>Statler</value></kiddie></meta>"
+                               "<root><kiddie><value>Gonzo</value></kiddie></root></elems>")
+        mock_get.return_value = t()
+        results = [mod for mod in StreamedModel.objects.filter(muppet_name="baz")]
+        self.assertEquals(["Rowlf", "Gonzo"], [mod.muppet_name for mod in results])
+
+    @patch_object(rest_client.Client, "GET")
+    def test_streamed_model_matches_field_variables_as_literals(self, mock_get):
+        class t:
+            content = StringIO('<elems><root><name lang="fr">Kermit la grenouille</name><name lang="en">Kermit</name></root></elems>')
+        mock_get.return_value = t()
+        results = [mod for mod in StreamedLangModel.objects.filter(name="baz")]
+        self.assertEquals(["Kermit"], [mod.name for mod in results])
+
+    @patch_object(rest_client.Client, "GET")
+    def test_streamed_model_raises_if_unique_field_matches_twice(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><kiddie><value>Rowlf</value><value>Gonzo</value></kiddie></root></elems>")
+        mock_get.return_value = t()
+        qry = StreamedModel.objects.filter(muppet_name="baz")
+        self.assertRaises(xpath.MultipleNodesReturnedException, lambda: [mod for mod in qry])
+
+    def test_etree_backend_returns_xpathed_values(self):
+        backend = xpath.backend
+        xpath.set_backend('etree')
+        try:
+            my_model = MyModel('<root><kiddie><value>Rowlf</value><age>7</age><age>8</age>'
+                               '<address><number>2</number></address><address><number>1</number></address></kiddie></root>')
+            self.assertEquals("Rowlf", my_model.muppet_name)
+            self.assertEquals("frog", my_model.muppet_type)
+            self.assertEquals([7, 8], my_model.muppet_ages)
+            self.assertEquals([1, 2], [address.number for address in my_model.muppet_addresses])
+            self.assertEquals(7, IntField(xpath='/root/kiddie/age[1]').parse(my_model._dom, None))
+        finally:
+            xpath.set_backend(backend)
+
+    def test_etree_backend_falls_back_to_pure_engine_for_other_expressions(self):
+        backend = xpath.backend
+        xpath.set_backend('etree')
+        try:
+            xml = xpath.domify('<root><kiddie name="Rowlf"><age>7</age><age>8</age></kiddie></root>')
+            self.assertEquals(8, IntField(xpath='/root/kiddie/age[last()]').parse(xml, None))
+            self.assertEquals('Rowlf', CharField(xpath='//age/../@name').parse(xml, None))
+            self.assertEquals([7, 8], Collection(IntField, xpath='/root/kiddie/age[. > 6]').parse(xml, None))
+        finally:
+            xpath.set_backend(backend)
+
+    def test_etree_backend_uses_default_namespace_of_document(self):
+        backend = xpath.backend
+        xpath.set_backend('etree')
+        try:
+            my_model = NsModel('<root xmlns="urn:test:namespace"><name>Fozzie</name><age>3</age></root>')
+            self.assertEquals("Fozzie", my_model.name)
+            self.assertEquals(3, my_model.age)
+        finally:
+            xpath.set_backend(backend)
+
+    @patch_object(rest_client.Client, "GET")
+    def test_etree_backend_models_adopt_fragments_of_collection_results(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><field1>hello</field1></root><root><field1>goodbye</field1></root></elems>")
+        mock_get.return_value = t()
+        backend = xpath.backend
+        xpath.set_backend('etree')
+        try:
+            results = [mod for mod in Simple.objects.filter(field1="baz")]
+            self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in results])
+        finally:
+            xpath.set_backend(backend)
+
+    def test_fields_bind_variables_in_their_xpath(self):
+        xml = xpath.domify('<root><name lang="en">Kermit</name><name lang="fr">Kermit la grenouille</name></root>')
+        self.assertEquals('Kermit', CharField(xpath='/root/name[@lang=$lang]', variables={'lang': 'en'}).parse(xml, None))
+        self.assertEquals('Kermit la grenouille',
+                          CharField(xpath='/root/name[@lang=$lang]', variables={'lang': 'fr'}).parse(xml, None))
+        self.assertEquals(['Kermit'], [m for m in Collection(CharField, xpath='/root/name[@lang=$lang]',
+                                                                  variables={'lang': 'en'}).parse(xml, None)])
+
+    def test_etree_backend_binds_field_variables(self):
+        backend = xpath.backend
+        xpath.set_backend('etree')
+        try:
+            xml = xpath.domify('<root><name lang="en">Kermit</name><name lang="fr">Kermit la grenouille</name></root>')
+            self.assertEquals('Kermit la grenouille',
+                              CharField(xpath='/root/name[@lang=$lang]', variables={'lang': 'fr'}).parse(xml, None))
+        finally:
+            xpath.set_backend(backend)
+
+    def test_unknown_backend_is_rejected(self):
+        self.assertRaises(ValueError, xpath.set_backend, 'libxml')
+
+    def test_compact_model_returns_xpathed_values(self):
+        my_model = CompactModel('<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>')
+        self.assertEquals('Rowlf', my_model.muppet_name)
+        self.assertEquals(7, my_model.muppet_age)
+
+    def test_compact_model_has_no_instance_dict(self):
+        my_model = CompactModel('<root><kiddie><value>Rowlf</value></kiddie></root>')
+        self.assertFalse(hasattr(my_model, '__dict__'))
+        self.assertRaises(AttributeError, setattr, my_model, 'foo', 'bar')
+
+    def test_compact_model_releases_xml_once_all_fields_are_parsed(self):
+        my_model = CompactModel('<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>')
+        my_model.muppet_name
+        self.assertNotEquals(None, my_model._dom)
+        my_model.muppet_age
+        self.assertEquals(None, my_model._xml)
+        self.assertEquals(None, my_model._dom)
+        self.assertEquals('Rowlf', my_model.muppet_name)
+
+    def test_compact_model_fields_are_settable(self):
+        my_model = CompactModel('<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>')
+        my_model.muppet_name = 'Fozzie'
+        self.assertEquals('Fozzie', my_model.muppet_name)
+        self.assertEquals(7, my_model.muppet_age)
+    
+    def test_drop_xml_retention_discards_xml_once_parsed(self):
+        my_model = DropXmlModel('<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>')
+        self.assertEquals('Rowlf', my_model.muppet_name)
+        self.assertEquals(None, my_model._xml)
+        self.assertEquals(7, my_model.muppet_age)
+
+    def test_drop_all_retention_parses_every_field_on_load(self):
+        my_model = DropAllModel('<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>')
+        self.assertEquals(None, my_model._xml)
+        self.assertEquals(None, my_model._dom)
+        self.assertEquals('Rowlf', my_model.muppet_name)
+        self.assertEquals(7, my_model.muppet_age)
+
+    def test_memory_footprint_shrinks_when_source_is_dropped(self):
+        xml = '<root><kiddie><value>Rowlf</value><age>7</age></kiddie></root>'
+        kept = MyModel(xml)
+        kept.muppet_name
+        dropped = DropAllModel(xml)
+        footprint = kept.memory_footprint()
+        self.assertTrue(footprint['xml'] > 0)
+        self.assertTrue(footprint['dom'] > 0)
+        self.assertEquals(footprint['total'], sum([footprint[key] for key in ('xml', 'dom', 'values')]) + sys.getsizeof(kept))
+        self.assertEquals(0, dropped.memory_footprint()['dom'])
+        self.assertTrue(dropped.memory_footprint()['total'] < footprint['total'])
+
+    def test_field_is_parsed_once_per_instance_when_read_from_many_threads(self):
+        my_model = SlowModel('<root><kiddie><value>Rowlf</value></kiddie></root>')
+        SlowCharField.parsed = 0
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(my_model.muppet_name)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(['Rowlf'] * 8, results)
+        self.assertEquals(1, SlowCharField.parsed)
+
+    def test_parsed_values_are_not_shared_between_instances(self):
+        rowlf = SlowModel('<root><kiddie><value>Rowlf</value></kiddie></root>')
+        gonzo = SlowModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        self.assertEquals('Rowlf', rowlf.muppet_name)
+        self.assertEquals('Gonzo', gonzo.muppet_name)
+
+    def test_dumped_model_loads_without_parsing_xml(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><age>7</age><address><number>10</number><street>1st Ave. South</street><city>MuppetVille</city><foobar>foo</foobar></address></kiddie></root>')
+        loaded = MyModel.loads(my_model.dumps())
+        self.assertEquals(None, loaded._xml)
+        self.assertEquals(None, loaded._dom)
+        self.assertEquals('Gonzo', loaded.muppet_name)
+        self.assertEquals('frog', loaded.muppet_type)
+        self.assertEquals([7], loaded.muppet_ages)
+        self.assertEquals('1st Ave. South', loaded.muppet_addresses[0].street)
+        self.assertEquals(['foo'], loaded.muppet_addresses[0].foobars)
+
+    def test_pickled_model_includes_one_to_one_children(self):
+        my_model = MasterModel(xml="<master><sub><name>fred</name></sub></master>")
+        loaded = pickle.loads(pickle.dumps(my_model))
+        self.assertEquals(None, loaded._dom)
+        self.assertEquals("fred", loaded.sub_model.name)
+
+    def test_loading_model_dumped_with_a_different_schema_raises_error(self):
+        version, values = Simple('<root><field1>hello</field1></root>')._dump()
+        try:
+            Simple._load(('not-the-schema', values))
+            self.fail("Expected SchemaMismatchError")
+        except SchemaMismatchError, e:
+            self.assertTrue("Simple" in str(e))
+
+    def test_field_schema_does_not_depend_on_default_object_identity(self):
+        self.assertEquals(CharField(xpath='/root/a', default=object())._schema(),
+                          CharField(xpath='/root/a', default=object())._schema())
+        self.assertNotEquals(CharField(xpath='/root/a', default='x')._schema(),
+                             CharField(xpath='/root/a', default='y')._schema())
+
+    def test_warmed_xpath_cache_holds_model_field_xpaths(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = directory + '/xpath.cache'
+            warm_xpath_cache(cache_file)
+            import xpath as pure_xpath
+            pure_xpath.XPath._cache.clear()
+            pure_xpath.XPath.load_cache(cache_file)
+            self.assertTrue('/root/kiddie/value' in pure_xpath.XPath._cache)
+            self.assertTrue('/address/number' in pure_xpath.XPath._cache)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch_object(rest_client.Client, "GET")
+    def test_manager_returns_cached_model_when_getting_for_a_registered_finder(self, mock_get):
+        class t:
+            content = StringIO("<root><field1>hello</field1></root>")
+            response_code = 200
+        mock_get.return_value = t()
+        CachedSimple.cache_backend.clear()
+        self.assertEquals("hello", CachedSimple.objects.get(field1="baz").field1)
+        val = CachedSimple.objects.get(field1="baz")
+        self.assertEquals({}, val._cache)
+        self.assertEquals("hello", val.field1)
+        self.assertEquals(1, mock_get.call_count)
+
+    @patch_object(rest_client.Client, "GET")
+    def test_caching_a_model_does_not_parse_its_fields(self, mock_get):
+        class t:
+            content = StringIO("<root><field1>hello</field1><field2>not a number</field2></root>")
+            response_code = 200
+        mock_get.return_value = t()
+        CachedSimple.cache_backend.clear()
+        self.assertEquals("hello", CachedSimple.objects.get(field1="baz").field1)
+        self.assertEquals("hello", CachedSimple.objects.get(field1="baz").field1)
+        self.assertEquals(1, mock_get.call_count)
+
+    @patch_object(rest_client.Client, "GET")
+    def test_manager_returns_cached_models_when_iterating_a_collection_of_results(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><field1>hello</field1></root><root><field1>goodbye</field1></root></elems>")
+        mock_get.return_value = t()
+        CachedSimple.cache_backend.clear()
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in CachedSimple.objects.filter(field1="baz")])
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in CachedSimple.objects.filter(field1="baz")])
+        self.assertEquals(2, len(CachedSimple.objects.filter(field1="baz")))
+        self.assertEquals(1, mock_get.call_count)
+
+    @patch_object(rest_client.Client, "GET")
+    def test_iterating_leaves_fields_unparsed_unless_backend_dumps_collections(self, mock_get):
+        class t:
+            def __init__(self):
+                self.content = StringIO("<elems><root><field1>hello</field1></root></elems>")
+        mock_get.return_value = t()
+        results = [mod for mod in LazyCachedSimple.objects.filter(field1="baz")]
+        self.assertEquals({}, results[0]._cache)
+        mock_get.return_value = t()
+        self.assertEquals(["hello"], [mod.field1 for mod in LazyCachedSimple.objects.filter(field1="baz")])
+        self.assertEquals(2, mock_get.call_count)
+
+    def test_loc_mem_cache_discards_least_recently_used_value_when_full(self):
+        cache = LocMemCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals({'a': 1, 'c': 3}, cache.get_many(['a', 'b', 'c']))
+        cache._entries.resize(1)
+        self.assertEquals(1, cache.max_entries)
+
+    def test_loc_mem_cache_expires_values_after_timeout(self):
+        cache = LocMemCache()
+        cache.set_many({'a': 1, 'b': 2}, timeout=-1)
+        cache.set('c', 3, timeout=60)
+        self.assertEquals(1, len(cache))
+        self.assertEquals({'c': 3}, cache.get_many(['a', 'b', 'c']))
+        self.assertEquals(1, len(cache))
+
+    def test_file_cache_stores_values_on_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            FileCache(directory).set('a', ['value'])
+            self.assertEquals(['value'], FileCache(directory).get('a'))
+            FileCache(directory).delete('a')
+            self.assertEquals('missing', FileCache(directory).get('a', 'missing'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_file_cache_removes_temporary_file_when_value_cannot_be_pickled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertRaises(Exception, FileCache(directory).set, 'a', lambda: None)
+            self.assertEquals([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
 class FunctionalTest(unittest.TestCase):
     def setUp(self):
         self.server = StubServer(8998)
@@ -321,6 +641,61 @@ class MyValidatingModel(Model):
     finders = { 
                 (muppet_name,): "http://foo.com/muppets/%s"
               }
+class StreamedModel(Model):
+    stream = True
+    muppet_name = CharField(xpath='/root/kiddie/value')
+    muppet_type = CharField(xpath='/root/kiddie/type', default='frog')
+    muppet_ages = Collection(IntField, xpath='/root/kiddie/age')
+    muppet_addresses = Collection(Address, xpath='/root/kiddie/address', order_by='number')
+
+    finders = {
+                (muppet_name,): "http://foo.com/muppets/%s"
+              }
+
+class StreamedLangModel(Model):
+    stream = True
+    name = CharField(xpath='/root/name[@lang=$l]', variables={'l': 'en'})
+
+    finders = {
+               (name,): "http://foo.com/lang/%s"
+              }
+
+class StreamedNsModel(Model):
+    stream = True
+    namespace='urn:test:namespace'
+    name=CharField(xpath='/root/name')
+    age=IntField(xpath='/root/age')
+
+    finders = {
+               (name,): "http://foo.com/ns/%s"
+              }
+
+class CompactModel(Model):
+    compact = True
+    muppet_name = CharField(xpath='/root/kiddie/value')
+    muppet_age = IntField(xpath='/root/kiddie/age')
+
+class DropXmlModel(Model):
+    retention = DROP_XML
+    muppet_name = CharField(xpath='/root/kiddie/value')
+    muppet_age = IntField(xpath='/root/kiddie/age')
+
+class DropAllModel(Model):
+    retention = DROP_ALL
+    muppet_name = CharField(xpath='/root/kiddie/value')
+    muppet_age = IntField(xpath='/root/kiddie/age')
+
+class SlowCharField(CharField):
+    parsed = 0
+
+    def parse(self, xml, namespace):
+        time.sleep(0.01)
+        SlowCharField.parsed += 1
+        return CharField.parse(self, xml, namespace)
+
+class SlowModel(Model):
+    muppet_name = SlowCharField(xpath='/root/kiddie/value')
+
 class NsModel(Model):
     namespace='urn:test:namespace'
     name=CharField(xpath='/root/name')
@@ -333,6 +708,24 @@ class Simple(Model):
                (field1,): "http://foo.com/simple/%s"
               }
 
+class CachedSimple(Model):
+    field1 = CharField(xpath='/root/field1')
+    field2 = IntField(xpath='/root/field2')
+
+    finders = {
+               (field1,): "http://foo.com/simple/%s"
+              }
+    cache_backend = LocMemCache(dump_collections=True)
+    cache_timeout = 60
+
+class LazyCachedSimple(Model):
+    field1 = CharField(xpath='/root/field1')
+
+    finders = {
+               (field1,): "http://foo.com/lazy/%s"
+              }
+    cache_backend = LocMemCache()
+
 class SubModel(Model):
     name = CharField(xpath='/sub/name')
 
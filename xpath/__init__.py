@@ -1,10 +1,18 @@
 from xpath.exceptions import *
+import cPickle
+import os
+import sys
+import tempfile
+import xpath.cache
 import xpath.exceptions
 import xpath.expr
 import xpath.parser
+import xpath.scanner
 import xpath.yappsrt
 
-__all__ = ['find', 'findnode', 'findvalue', 'XPathContext', 'XPath']
+__all__ = ['find', 'findnode', 'findvalue', 'iterfind', 'find_many',
+           'document_context', 'register_function',
+           'XPathContext', 'XPath', 'XPathSet']
 __all__.extend((x for x in dir(xpath.exceptions) if not x.startswith('_')))
 
 def api(f):
@@ -30,6 +38,8 @@ class XPathContext(object):
         self.default_namespace = None
         self.namespaces = {}
         self.variables = {}
+        self.memoize = False
+        self.name_index = False
 
         if document is not None:
             if document.nodeType != document.DOCUMENT_NODE:
@@ -45,21 +55,33 @@ class XPathContext(object):
         self.update(**kwargs)
 
     def clone(self):
+        """Return a copy of the context.
+
+        The copy shares the namespaces and variables dicts of this
+        context until update() replaces them, so replace them through
+        update() rather than changing them in place.
+
+        """
         dup = XPathContext()
-        dup.default_namespace = self.default_namespace
-        dup.namespaces.update(self.namespaces)
-        dup.variables.update(self.variables)
+        dup.__dict__.update(self.__dict__)
         return dup
 
     def update(self, default_namespace=None, namespaces=None,
-                  variables=None, **kwargs):
+                  variables=None, memoize=None, name_index=None, **kwargs):
         if default_namespace is not None:
             self.default_namespace = default_namespace
+        if memoize is not None:
+            self.memoize = memoize
+        if name_index is not None:
+            self.name_index = name_index
         if namespaces is not None:
             self.namespaces = namespaces
         if variables is not None:
             self.variables = variables
-        self.variables.update(kwargs)
+        if kwargs:
+            # The variables may be shared with a clone, or the caller.
+            self.variables = dict(self.variables)
+            self.variables.update(kwargs)
 
     @api
     def find(self, expr, node, **kwargs):
@@ -69,6 +91,10 @@ class XPathContext(object):
     def findnode(self, expr, node, **kwargs):
         return xpath.findnode(expr, node, context=self, **kwargs)
 
+    @api
+    def iterfind(self, expr, node, **kwargs):
+        return xpath.iterfind(expr, node, context=self, **kwargs)
+
     @api
     def findvalue(self, expr, node, **kwargs):
         return xpath.findvalue(expr, node, context=self, **kwargs)
@@ -78,48 +104,167 @@ class XPathContext(object):
         return xpath.findvalues(expr, node, context=self, **kwargs)
 
 class XPath():
-    _max_cache = 100
-    _cache = {}
+    """A compiled expression.
 
-    def __init__(self, expr):
-        """Init docs.
+    Values for the variables in the expression ($name) are given to each
+    evaluation, as keyword arguments of find() and the other methods, or
+    as a dict in their variables argument.  An expression that only
+    differs in those values is then parsed and compiled once, e.g.:
+
+        item = XPath('//item[@id = $id]')
+        item.find(document, id='123')
+
+    """
+    _cache = xpath.cache.LRUCache(100)
+
+    def __init__(self, expr, parsed=None):
+        """Parse and compile expr.  parsed may supply the expression tree
+        from an earlier parse of the same string, which is then compiled
+        without parsing it again.
         """
-        try:
-            parser = xpath.parser.XPath(xpath.parser.XPathScanner(str(expr)))
-            self.expr = parser.XPath()
-        except xpath.yappsrt.SyntaxError, e:
-            raise XPathParseError(str(expr), e.pos, e.msg)
+        if parsed is not None:
+            self.expr = parsed
+        else:
+            try:
+                parser = xpath.parser.XPath(xpath.scanner.XPathScanner(str(expr)))
+                self.expr = parser.XPath().fold()
+            except xpath.yappsrt.SyntaxError, e:
+                raise XPathParseError(str(expr), e.pos, e.msg)
+        self._evaluate = self.expr.compile()
+        self._iterate = self.expr.compile_lazy()
 
     @classmethod
     def get(cls, s):
+        """Return the compiled expression for s, reusing the one in the
+        expression cache if there is one.
+
+        """
         if isinstance(s, cls):
             return s
-        try:
-            return cls._cache[s]
-        except KeyError:
-            if len(cls._cache) > cls._max_cache:
-                cls._cache.clear()
+        expr = cls._cache.get(s)
+        if expr is None:
             expr = cls(s)
-            cls._cache[s] = expr
-            return expr
+            cls._cache.put(s, expr)
+        return expr
+
+    @classmethod
+    def warm(cls, expressions):
+        """Compile expressions into the expression cache ahead of use.
+
+        The cache grows to hold them all, so that none of the warmed
+        expressions are evicted to make room for the others.
+
+        """
+        for s in expressions:
+            if s not in cls._cache:
+                expr = cls(s)
+                cls._make_room(1)
+                cls._cache.put(s, expr)
+
+    @classmethod
+    def dump_cache(cls, filename):
+        """Write the parsed expressions in the expression cache to a file,
+        from which load_cache() can restore them in another process
+        without parsing them.
+
+        The file is replaced atomically, so processes loading it never see
+        it partly written.
+
+        """
+        expressions = [(s, x.expr) for s, x in cls._cache.items()
+                       if isinstance(s, basestring)]
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            temp_file = os.fdopen(handle, 'wb')
+            try:
+                cPickle.dump((cache_version(), expressions), temp_file,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                temp_file.close()
+            os.rename(temp_path, filename)
+        except:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load_cache(cls, filename):
+        """Compile the expressions in a file written by dump_cache() into
+        the expression cache, growing it to hold them all, and return how
+        many there were.
+
+        Files which are missing, unreadable, or were written by another
+        version of this package or of Python are ignored, and the
+        expressions are parsed as they are first used instead.
+
+        """
+        try:
+            cache_file = open(filename, 'rb')
+        except IOError:
+            return 0
+        try:
+            try:
+                version, expressions = cPickle.load(cache_file)
+            except Exception:
+                return 0
+        finally:
+            cache_file.close()
+        if version != cache_version():
+            return 0
+        cls._make_room(len([s for s, parsed in expressions
+                            if s not in cls._cache]))
+        for s, parsed in expressions:
+            cls._cache.put(s, cls(s, parsed))
+        return len(expressions)
+
+    @classmethod
+    def _make_room(cls, count):
+        # Grow the cache rather than evict entries to fit count more.
+        needed = len(cls._cache) + count
+        if needed > cls._cache.maxsize:
+            cls._cache.resize(needed)
+
+    @classmethod
+    def set_cache_size(cls, maxsize):
+        """Change the number of compiled expressions kept in the cache."""
+        cls._cache.resize(maxsize)
+
+    @classmethod
+    def cache_stats(cls):
+        """Return the expression cache's hit, miss and eviction counts,
+        along with its current and maximum size.
+
+        """
+        return cls._cache.stats()
 
     @api
     def find(self, node, context=None, **kwargs):
-        if context is None:
-            context = XPathContext(node, **kwargs)
-        elif kwargs:
-            context = context.clone()
-            context.update(**kwargs)
-        return self.expr.evaluate(node, 1, 1, context)
+        context = evaluation_context(node, context, kwargs)
+        return xpath.expr.evaluation(self._evaluate, context.memoize,
+                                     node, 1, 1, context)
 
     @api
     def findnode(self, node, context=None, **kwargs):
-        result = self.find(node, context, **kwargs)
-        if not xpath.expr.nodesetp(result):
-            raise XPathTypeError("expression is not a node-set")
-        if len(result) == 0:
-            return None
-        return result[0]
+        for n in self.iterfind(node, context, **kwargs):
+            return n
+        return None
+
+    @api
+    def iterfind(self, node, context=None, **kwargs):
+        """Return an iterator over the nodes selected by the expression.
+
+        Where the expression allows it, nodes are found only as the
+        iterator is consumed, so taking the first few of them doesn't
+        evaluate the whole expression.
+
+        """
+        context = evaluation_context(node, context, kwargs)
+        if self._iterate is None or context.memoize:
+            result = self.find(node, context)
+            if not xpath.expr.nodesetp(result):
+                raise XPathTypeError("expression is not a node-set")
+            return iter(result)
+        return self._iterate(node, 1, 1, context)
 
     @api
     def findvalue(self, node, context=None, **kwargs):
@@ -145,6 +290,96 @@ class XPath():
     def __str__(self):
         return str(self.expr)
 
+class XPathSet(object):
+    """A set of named expressions, evaluated together over the same node.
+
+    Steps shared by the beginnings of several location paths in the set
+    are only evaluated once.
+
+    """
+    _cache = xpath.cache.LRUCache(100)
+
+    def __init__(self, exprs):
+        self.exprs = dict((name, XPath.get(expr))
+                          for name, expr in exprs.items())
+        self._evaluate = xpath.expr.compile_many(
+            dict((name, x.expr) for name, x in self.exprs.items()))
+
+    @classmethod
+    def get(cls, exprs):
+        """Return the compiled set for the dict of names to expressions,
+        reusing the one in the cache if there is one.
+
+        """
+        if isinstance(exprs, cls):
+            return exprs
+        key = tuple(sorted((name, str(expr)) for name, expr in exprs.items()))
+        compiled = cls._cache.get(key)
+        if compiled is None:
+            compiled = cls(exprs)
+            cls._cache.put(key, compiled)
+        return compiled
+
+    @api
+    def find(self, node, context=None, **kwargs):
+        """Return a dict of the names in the set to the values of their
+        expressions.
+
+        """
+        context = evaluation_context(node, context, kwargs)
+        return xpath.expr.evaluation(self._evaluate, context.memoize,
+                                     node, context)
+
+    def __repr__(self):
+        return '%s.%s(%r)' % (self.__class__.__module__,
+                              self.__class__.__name__,
+                              dict((name, str(x))
+                                   for name, x in self.exprs.items()))
+
+register_function = xpath.expr.register_function
+
+def document_context(node):
+    """Return the context of the document containing node, with the
+    namespaces declared on its document element.
+
+    The context is built once per document and cached, weakly keyed by the
+    document, so it must not be changed; clone() it instead.  Call
+    xpath.expr.invalidate_index() after changing the document's namespace
+    declarations.
+
+    """
+    if node.nodeType != node.DOCUMENT_NODE:
+        node = node.ownerDocument
+    try:
+        context = xpath.expr.document_contexts.get(node)
+        if context is None:
+            context = xpath.expr.document_contexts[node] = XPathContext(node)
+    except TypeError:
+        # The document can't be weakly referenced, so it can't be cached.
+        context = XPathContext(node)
+    return context
+
+def evaluation_context(node, context, kwargs):
+    """Return the context to evaluate an expression against node in: the
+    caller's context, or the document's, updated with kwargs.
+
+    """
+    if context is None:
+        context = document_context(node)
+    if kwargs:
+        context = context.clone()
+        context.update(**kwargs)
+    return context
+
+def cache_version():
+    """Return the version dumped expression caches are stamped with."""
+    return (xpath.expr.AST_VERSION, sys.version_info[:2])
+
+# A worker process can start with the expressions dumped by another one
+# already parsed, by naming the file in XPATH_CACHE_FILE.
+if os.environ.get('XPATH_CACHE_FILE'):
+    XPath.load_cache(os.environ['XPATH_CACHE_FILE'])
+
 @api
 def find(expr, node, **kwargs):
     return XPath.get(expr).find(node, **kwargs)
@@ -153,6 +388,14 @@ def find(expr, node, **kwargs):
 def findnode(expr, node, **kwargs):
     return XPath.get(expr).findnode(node, **kwargs)
 
+@api
+def iterfind(expr, node, **kwargs):
+    return XPath.get(expr).iterfind(node, **kwargs)
+
+@api
+def find_many(exprs, node, **kwargs):
+    return XPathSet.get(exprs).find(node, **kwargs)
+
 @api
 def findvalue(expr, node, **kwargs):
     return XPath.get(expr).findvalue(node, **kwargs)
@@ -0,0 +1,125 @@
+import threading
+
+class LRUCache(object):
+    """A thread-safe mapping holding at most maxsize entries.  When it is
+    full, the least recently used entry is evicted to make room.
+
+    Lookups through get() are counted as hits or misses, and evictions are
+    counted too, so the size of the cache can be tuned to the workload.
+
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._links = {}
+        # A circular doubly linked list of [prev, next, key, value] links,
+        # ordered from least to most recently used.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = self._links[key] = [None, None, key, value]
+            self._append(link)
+            self._evict(self.maxsize)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def resize(self, maxsize):
+        self._lock.acquire()
+        try:
+            self.maxsize = maxsize
+            self._evict(maxsize)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._links),
+                'maxsize': self.maxsize}
+
+    def keys(self):
+        """Return the keys, from least to most recently used."""
+        return [key for key, value in self.items()]
+
+    def items(self):
+        """Return the (key, value) pairs, from least to most recently used,
+        without counting them as lookups.
+
+        """
+        self._lock.acquire()
+        try:
+            items = []
+            link = self._root[1]
+            while link is not self._root:
+                items.append((link[2], link[3]))
+                link = link[1]
+            return items
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def _evict(self, maxsize):
+        while len(self._links) > maxsize:
+            link = self._root[1]
+            self._unlink(link)
+            del self._links[link[2]]
+            self.evictions += 1
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = link
+        self._root[0] = link
@@ -0,0 +1,340 @@
+"""A compact, read-only document tree for the XPath engine.
+
+minidom keeps a dictionary per node, and NamedNodeMap and Attr objects per
+element, which makes documents many times larger than their source.  The
+nodes here are built directly from expat events and hold their fields in
+__slots__.  They implement the parts of the DOM API which xpath.expr uses
+(node types, names, parents, children, siblings, attributes), plus
+toxml(), getAttribute() and hasAttribute().
+
+Character data, including CDATA sections, is merged into Text nodes, and
+document type declarations are dropped.  Namespace declarations appear
+as attributes, as they do in minidom.
+
+"""
+import xml.dom
+from xml.parsers import expat
+
+class Node(object):
+    __slots__ = ('parentNode', 'ownerDocument', 'previousSibling',
+                 'nextSibling', '__weakref__')
+
+    ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+    ATTRIBUTE_NODE = xml.dom.Node.ATTRIBUTE_NODE
+    TEXT_NODE = xml.dom.Node.TEXT_NODE
+    CDATA_SECTION_NODE = xml.dom.Node.CDATA_SECTION_NODE
+    ENTITY_REFERENCE_NODE = xml.dom.Node.ENTITY_REFERENCE_NODE
+    ENTITY_NODE = xml.dom.Node.ENTITY_NODE
+    PROCESSING_INSTRUCTION_NODE = xml.dom.Node.PROCESSING_INSTRUCTION_NODE
+    COMMENT_NODE = xml.dom.Node.COMMENT_NODE
+    DOCUMENT_NODE = xml.dom.Node.DOCUMENT_NODE
+    DOCUMENT_TYPE_NODE = xml.dom.Node.DOCUMENT_TYPE_NODE
+    DOCUMENT_FRAGMENT_NODE = xml.dom.Node.DOCUMENT_FRAGMENT_NODE
+    NOTATION_NODE = xml.dom.Node.NOTATION_NODE
+
+    attributes = None
+    childNodes = ()
+    localName = None
+    namespaceURI = None
+    prefix = None
+    nodeValue = None
+
+    def __init__(self):
+        self.parentNode = None
+        self.ownerDocument = None
+        self.previousSibling = None
+        self.nextSibling = None
+
+    @property
+    def firstChild(self):
+        if self.childNodes:
+            return self.childNodes[0]
+        return None
+
+    @property
+    def lastChild(self):
+        if self.childNodes:
+            return self.childNodes[-1]
+        return None
+
+    def hasChildNodes(self):
+        return bool(self.childNodes)
+
+    def toxml(self):
+        out = []
+        self._write(out)
+        return u''.join(out)
+
+    def _append(self, node):
+        children = self.childNodes
+        if not children:
+            children = self.childNodes = []
+        else:
+            last = children[-1]
+            last.nextSibling = node
+            node.previousSibling = last
+        children.append(node)
+        node.parentNode = self
+
+class Attributes(list):
+    """The attributes of an element, with the parts of the NamedNodeMap
+    interface the engine uses.
+
+    """
+    __slots__ = ()
+
+    @property
+    def length(self):
+        return len(self)
+
+    def item(self, index):
+        if 0 <= index < len(self):
+            return self[index]
+        return None
+
+no_attributes = Attributes()
+
+class Document(Node):
+    __slots__ = ('childNodes', 'documentElement')
+
+    nodeType = Node.DOCUMENT_NODE
+    nodeName = '#document'
+
+    def __init__(self):
+        Node.__init__(self)
+        self.childNodes = ()
+        self.documentElement = None
+
+    def getElementById(self, id):
+        # Without a DTD no attribute is of type ID.
+        return None
+
+    def _write(self, out):
+        out.append(u'<?xml version="1.0" ?>')
+        for child in self.childNodes:
+            child._write(out)
+
+class Element(Node):
+    __slots__ = ('tagName', 'localName', 'namespaceURI', 'prefix',
+                 'childNodes', 'attributes')
+
+    nodeType = Node.ELEMENT_NODE
+
+    def __init__(self, tagName, namespaceURI, localName, prefix):
+        Node.__init__(self)
+        self.tagName = tagName
+        self.namespaceURI = namespaceURI
+        self.localName = localName
+        self.prefix = prefix
+        self.childNodes = ()
+        self.attributes = no_attributes
+
+    @property
+    def nodeName(self):
+        return self.tagName
+
+    def getAttribute(self, name):
+        for attr in self.attributes:
+            if attr.name == name:
+                return attr.value
+        return u''
+
+    def hasAttribute(self, name):
+        for attr in self.attributes:
+            if attr.name == name:
+                return True
+        return False
+
+    def _write(self, out):
+        out.append(u'<' + self.tagName)
+        for attr in self.attributes:
+            out.append(u' %s="%s"' % (attr.name, escape(attr.value)))
+        if self.childNodes:
+            out.append(u'>')
+            for child in self.childNodes:
+                child._write(out)
+            out.append(u'</%s>' % self.tagName)
+        else:
+            out.append(u'/>')
+
+class Attr(Node):
+    __slots__ = ('name', 'value', 'localName', 'namespaceURI', 'prefix',
+                 'ownerElement')
+
+    nodeType = Node.ATTRIBUTE_NODE
+
+    def __init__(self, name, namespaceURI, localName, prefix, value):
+        Node.__init__(self)
+        self.name = name
+        self.namespaceURI = namespaceURI
+        self.localName = localName
+        self.prefix = prefix
+        self.value = value
+        self.ownerElement = None
+
+    @property
+    def nodeName(self):
+        return self.name
+
+    @property
+    def nodeValue(self):
+        return self.value
+
+class CharacterData(Node):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        Node.__init__(self)
+        self.data = data
+
+    @property
+    def nodeValue(self):
+        return self.data
+
+class Text(CharacterData):
+    __slots__ = ()
+
+    nodeType = Node.TEXT_NODE
+    nodeName = '#text'
+
+    def _write(self, out):
+        out.append(escape(self.data))
+
+class Comment(CharacterData):
+    __slots__ = ()
+
+    nodeType = Node.COMMENT_NODE
+    nodeName = '#comment'
+
+    def _write(self, out):
+        out.append(u'<!--%s-->' % self.data)
+
+class ProcessingInstruction(CharacterData):
+    __slots__ = ('target',)
+
+    nodeType = Node.PROCESSING_INSTRUCTION_NODE
+
+    def __init__(self, target, data):
+        CharacterData.__init__(self, data)
+        self.target = target
+
+    @property
+    def nodeName(self):
+        return self.target
+
+    def _write(self, out):
+        out.append(u'<?%s %s?>' % (self.target, self.data))
+
+def escape(data):
+    return (data.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+                .replace(u'"', u'&quot;').replace(u'>', u'&gt;'))
+
+class Builder(object):
+    """Builds a Document from the events of an expat parser."""
+
+    def __init__(self):
+        self.document = Document()
+        self.node = self.document
+        self.declarations = []
+        # (namespaceURI, localName, prefix, qualified name) by expat name.
+        self.names = {}
+
+        self.parser = parser = expat.ParserCreate(namespace_separator=' ')
+        parser.namespace_prefixes = True
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.StartNamespaceDeclHandler = self.start_namespace
+        parser.CharacterDataHandler = self.character_data
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processing_instruction
+
+    def name(self, name):
+        try:
+            return self.names[name]
+        except KeyError:
+            parts = name.split(' ')
+            if len(parts) == 1:
+                split = (None, name, None, name)
+            elif len(parts) == 2:
+                split = (parts[0], parts[1], None, parts[1])
+            else:
+                split = (parts[0], parts[1], parts[2],
+                         u'%s:%s' % (parts[2], parts[1]))
+            self.names[name] = split
+            return split
+
+    def append(self, node):
+        node.ownerDocument = self.document
+        self.node._append(node)
+
+    def start_element(self, name, attributes):
+        namespaceURI, localName, prefix, tagName = self.name(name)
+        element = Element(tagName, namespaceURI, localName, prefix)
+        self.append(element)
+        if self.node is self.document:
+            self.document.documentElement = element
+        if attributes or self.declarations:
+            attrs = element.attributes = Attributes()
+            for prefix, uri in self.declarations:
+                if prefix is None:
+                    attr = Attr(u'xmlns', xml.dom.XMLNS_NAMESPACE, u'xmlns',
+                                None, uri or u'')
+                else:
+                    attr = Attr(u'xmlns:' + prefix, xml.dom.XMLNS_NAMESPACE,
+                                prefix, u'xmlns', uri or u'')
+                attrs.append(attr)
+            self.declarations = []
+            for i in xrange(0, len(attributes), 2):
+                namespaceURI, localName, prefix, qname = self.name(attributes[i])
+                attrs.append(Attr(qname, namespaceURI, localName, prefix,
+                                  attributes[i + 1]))
+            # Attributes are kept in the order xpath.expr gives them in
+            # document order.
+            attrs.sort(key=lambda attr: attr.name)
+            for attr in attrs:
+                attr.ownerElement = element
+                attr.ownerDocument = self.document
+        self.node = element
+
+    def end_element(self, name):
+        self.node = self.node.parentNode
+
+    def start_namespace(self, prefix, uri):
+        self.declarations.append((prefix, uri))
+
+    def character_data(self, data):
+        last = self.node.lastChild
+        if last is not None and last.nodeType == Node.TEXT_NODE:
+            last.data += data
+        else:
+            self.append(Text(data))
+
+    def comment(self, data):
+        self.append(Comment(data))
+
+    def processing_instruction(self, target, data):
+        self.append(ProcessingInstruction(target, data))
+
+def parseString(string):
+    """Parse an XML string into a Document."""
+    builder = Builder()
+    builder.parser.Parse(string, True)
+    return builder.document
+
+def parse(file):
+    """Parse an XML file object, or the file with the given name, into a
+    Document.
+
+    """
+    builder = Builder()
+    if isinstance(file, basestring):
+        f = open(file, 'rb')
+        try:
+            builder.parser.ParseFile(f)
+        finally:
+            f.close()
+    else:
+        builder.parser.ParseFile(file)
+    return builder.document
@@ -0,0 +1,327 @@
+"""Evaluate XPath expressions against ElementTree elements.
+
+ElementTree elements have no parent pointers, keep text in .text and
+.tail rather than in nodes, and can't be told apart from their copies by
+anything but identity, so the engine can't walk them directly.  adapt()
+builds an xpath.dom Document mirroring an element in one pass over the
+tree, without serializing and reparsing it.  The document, its parent and
+sibling links and its DocumentIndex are then reused by every expression
+evaluated against it.
+
+compile_findall() goes the other way for the expressions ElementTree
+can evaluate itself, translating them into findall() calls.
+
+ElementTree doesn't keep namespace prefixes, so element and attribute
+names are the local names: name() returns the same as local-name().  Nor
+does it keep namespace declarations, so they don't appear as attributes,
+and its parser drops comments and processing instructions.
+
+"""
+import xml.etree.ElementTree as et
+
+import xpath
+import xpath.dom
+from xpath.cache import LRUCache
+from xpath.expr import (AbsolutePathExpr, AnyKindTest, AxisStep,
+                        EqualityExpr, LiteralExpr, NameTest, PathExpr,
+                        PredicateList, NUMBER, axes)
+
+class Element(xpath.dom.Element):
+    """An element adapted from an ElementTree element, which is available
+    as .element if adapt() was asked to keep it.
+
+    """
+    __slots__ = ('element',)
+
+def split(name):
+    """Split an ElementTree name into (namespaceURI, localName)."""
+    if name[:1] == '{':
+        namespaceURI, localName = name[1:].split('}', 1)
+        return namespaceURI, localName
+    return None, name
+
+def adapt(element, keep_elements=False):
+    """Return an xpath.dom Document whose document element mirrors
+    'element', an ElementTree element, or the root of an ElementTree.
+
+    If keep_elements is true, each adapted element refers back to its
+    source element, so that results can be mapped back to the tree.
+
+    """
+    if isinstance(element, et.ElementTree):
+        element = element.getroot()
+    document = xpath.dom.Document()
+    # Names are shared between elements, as expat would share them.
+    names = {}
+    pending = [(document, element)]
+    while pending:
+        parent, elem = pending.pop()
+        tag = elem.tag
+        if tag is et.Comment:
+            node = xpath.dom.Comment(elem.text or u'')
+        elif tag is et.PI:
+            parts = (elem.text or u'').split(None, 1) + [u'', u'']
+            node = xpath.dom.ProcessingInstruction(parts[0], parts[1])
+        else:
+            try:
+                namespaceURI, localName = names[tag]
+            except KeyError:
+                namespaceURI, localName = names[tag] = split(tag)
+            node = Element(localName, namespaceURI, localName, None)
+            if keep_elements:
+                node.element = elem
+            else:
+                node.element = None
+            if elem.attrib:
+                attrs = node.attributes = xpath.dom.Attributes()
+                for name, value in elem.attrib.items():
+                    namespaceURI, localName = split(name)
+                    attr = xpath.dom.Attr(localName, namespaceURI, localName,
+                                          None, value)
+                    attr.ownerElement = node
+                    attr.ownerDocument = document
+                    attrs.append(attr)
+                attrs.sort(key=lambda attr: attr.name)
+            if elem.text:
+                text = xpath.dom.Text(elem.text)
+                text.ownerDocument = document
+                node._append(text)
+            pending.extend((node, child) for child in reversed(elem))
+        node.ownerDocument = document
+        parent._append(node)
+        if parent is document:
+            document.documentElement = node
+        elif elem.tail:
+            # The tail follows the element, before its next sibling, which
+            # is still pending.
+            tail = xpath.dom.Text(elem.tail)
+            tail.ownerDocument = document
+            parent._append(tail)
+    return document
+
+def find(expr, element, **kwargs):
+    """Evaluate an expression against an ElementTree element.  Elements
+    in a node-set result are returned as the ElementTree elements they
+    mirror; other nodes are returned as xpath.dom nodes.
+
+    """
+    document = adapt(element, keep_elements=True)
+    result = xpath.find(expr, document, **kwargs)
+    if isinstance(result, list):
+        result = [mirrored(node) for node in result]
+    return result
+
+def mirrored(node):
+    if isinstance(node, Element) and node.element is not None:
+        return node.element
+    return node
+
+#
+# Translation into ElementPath.
+#
+
+# Compiled findall functions, keyed by (expression, default namespace).
+# None is cached for expressions which can't be translated.
+findall_cache = LRUCache(100)
+
+def compile_findall(expr, default_namespace=None, namespaces=None):
+    """Translate an expression into a function of an ElementTree root
+    element which returns the elements the expression selects, in document
+    order, or the values of the attributes selected by a final attribute
+    step.  The root element is taken to be the child of the document node.
+
+    Returns None when ElementPath can't evaluate the expression with the
+    same result: only paths of child steps, a final descendant step ('//'),
+    a final attribute step, and predicates of the forms [@a], [@a='v'],
+    [name] and [n] are translated.  Namespace prefixes are looked up in
+    namespaces, as ElementTree doesn't keep them.
+
+    """
+    if namespaces is None:
+        namespaces = {}
+    key = (expr, default_namespace, tuple(sorted(namespaces.items())))
+    findall = findall_cache.get(key, False)
+    if findall is False:
+        findall = translate(xpath.XPath.get(expr).expr, default_namespace,
+                            namespaces)
+        findall_cache.put(key, findall)
+    return findall
+
+def translate(expr, default_namespace, namespaces):
+    if isinstance(expr, AbsolutePathExpr):
+        if expr.path is None:
+            return None
+        steps = expr.path.steps
+    elif isinstance(expr, PathExpr):
+        # Relative paths are evaluated from the document node too.
+        steps = expr.steps
+    else:
+        return None
+
+    if (len(steps) == 1 and isinstance(steps[0], AxisStep) and
+        steps[0].axis is axes['self'] and
+        isinstance(steps[0].test, AnyKindTest)):
+        # The document itself, whose value is its root element's.
+        return lambda root: [root]
+
+    elements = []
+    attribute = None
+    descendant = False
+    for i, step in enumerate(steps):
+        last = i == len(steps) - 1
+        predicates = []
+        if isinstance(step, PredicateList):
+            predicates = step.predicates
+            step = step.expr
+        if not isinstance(step, AxisStep):
+            return None
+        if (step.axis is axes['descendant-or-self'] and not predicates and
+            not last and isinstance(step.test, AnyKindTest)):
+            descendant = True
+            continue
+        if step.axis is axes['attribute'] and last and elements:
+            attribute = attribute_name(step, namespaces)
+            if attribute is None or predicates:
+                return None
+            break
+        if step.axis is axes['descendant'] and not predicates:
+            descendant = True
+        elif step.axis is not axes['child']:
+            return None
+        if elements and elements[-1][0]:
+            # findall() doesn't merge the descendants of nested contexts
+            # into document order, so '//' can only come last.
+            return None
+        tag = element_tag(step.test, default_namespace, namespaces)
+        if tag is None:
+            return None
+        translated = []
+        for j, pred in enumerate(predicates):
+            translated.append(translate_predicate(pred, j, tag,
+                                                  default_namespace,
+                                                  namespaces))
+            if translated[-1] is None:
+                return None
+        elements.append((descendant, tag, translated))
+        descendant = False
+    if descendant or not elements:
+        return None
+
+    first, rest = elements[0], elements[1:]
+    path = []
+    for k, (descendant, tag, predicates) in enumerate(rest):
+        if descendant:
+            path.append(k and '//' or './/')
+        elif k:
+            path.append('/')
+        path.append(tag + ''.join([pattern for pattern, test in predicates]))
+    path = ''.join(path)
+
+    def matches_root(root):
+        descendant, tag, predicates = first
+        if tag != '*' and root.tag != tag:
+            return False
+        for pattern, test in predicates:
+            if not test(root):
+                return False
+        return True
+
+    if first[0]:
+        # '//name' matches the root too.
+        descendants = './/' + first[1] + ''.join(
+            [pattern for pattern, test in first[2]])
+        def findall(root):
+            found = root.findall(descendants)
+            if matches_root(root):
+                found.insert(0, root)
+            return found
+    elif path:
+        def findall(root):
+            if matches_root(root):
+                return root.findall(path)
+            return []
+    else:
+        def findall(root):
+            if matches_root(root):
+                return [root]
+            return []
+
+    if attribute is None:
+        return findall
+    def find_attributes(root):
+        return [unicode(elem.get(attribute)) for elem in findall(root)
+                if attribute in elem.attrib]
+    return find_attributes
+
+def qualified_name(test, namespace, namespaces):
+    """Return the ElementTree name matched by a NameTest, using namespace
+    for unprefixed names, or None if the test isn't a single name.
+
+    """
+    if test.prefix is not None:
+        namespace = namespaces.get(test.prefix)
+        if namespace is None:
+            return None
+    if test.localName == '*':
+        return None
+    if namespace:
+        return '{%s}%s' % (namespace, test.localName)
+    return test.localName
+
+def element_tag(test, default_namespace, namespaces):
+    if not isinstance(test, NameTest):
+        return None
+    if test.prefix == '*':
+        return '*'
+    return qualified_name(test, default_namespace, namespaces)
+
+def attribute_name(step, namespaces):
+    expr = step
+    while isinstance(expr, PathExpr) and len(expr.steps) == 1:
+        expr = expr.steps[0]
+    if (isinstance(expr, AxisStep) and expr.axis is axes['attribute'] and
+        isinstance(expr.test, NameTest) and expr.test.prefix != '*'):
+        return qualified_name(expr.test, None, namespaces)
+    return None
+
+def translate_predicate(pred, index, tag, default_namespace, namespaces):
+    """Translate a predicate into (ElementPath predicate, test of the root
+    element), or None.
+
+    """
+    expr = pred
+    while isinstance(expr, PathExpr) and len(expr.steps) == 1:
+        expr = expr.steps[0]
+
+    if isinstance(expr, LiteralExpr) and expr.type == NUMBER:
+        # ElementPath counts siblings with the same tag, ignoring any
+        # predicate before this one.
+        position = expr.literal
+        if index or tag == '*' or position != int(position) or position < 1:
+            return None
+        return '[%d]' % position, lambda root: position == 1
+
+    name = attribute_name(expr, namespaces)
+    if name is not None:
+        return '[@%s]' % name, lambda root: name in root.attrib
+
+    if isinstance(expr, AxisStep) and expr.axis is axes['child']:
+        child = element_tag(expr.test, default_namespace, namespaces)
+        if child not in (None, '*'):
+            return ('[%s]' % child,
+                    lambda root: root.find(child) is not None)
+        return None
+
+    if isinstance(expr, EqualityExpr) and expr.op == '=':
+        left, right = expr.left, expr.right
+        while isinstance(right, PathExpr) and len(right.steps) == 1:
+            right = right.steps[0]
+        name = attribute_name(left, namespaces)
+        if (name is not None and isinstance(right, LiteralExpr) and
+            right.type != NUMBER):
+            value = right.literal
+            for quote in '\'"':
+                if quote not in value:
+                    return ("[@%s=%s%s%s]" % (name, quote, value, quote),
+                            lambda root: root.get(name) == value)
+    return None
@@ -1,8 +1,10 @@
 from __future__ import division
 from itertools import *
+import bisect
 import math
 import operator
 import re
+import threading
 import xml.dom
 import weakref
 
@@ -14,15 +16,61 @@ import xpath
 # Data model functions.
 #
 
+class EvaluationState(threading.local):
+    """Per-thread state of the evaluation in progress, set up by
+    evaluation().
+
+    values   -- Memo of node string-values, if memoization was asked for.
+    nodesets -- Sets of string-values of absolute paths, keyed by
+                expression and document; see compile_string_values().
+
+    """
+    values = None
+    nodesets = None
+
+evaluation_state = EvaluationState()
+
+def evaluation(f, memoize, *args):
+    """Call f(*args) as a single evaluation, memoizing node string-values
+    for the duration of the call if 'memoize' is true.
+
+    Evaluations started within another one share its state.
+
+    """
+    if evaluation_state.nodesets is not None:
+        return f(*args)
+    evaluation_state.nodesets = {}
+    if memoize:
+        evaluation_state.values = {}
+    try:
+        return f(*args)
+    finally:
+        evaluation_state.nodesets = None
+        evaluation_state.values = None
+
 def string_value(node):
     """Compute the string-value of a node."""
+    memo = evaluation_state.values
+    if memo is None:
+        return compute_string_value(node)
+    try:
+        return memo[node]
+    except KeyError:
+        value = memo[node] = compute_string_value(node)
+        return value
+
+def compute_string_value(node):
     if (node.nodeType == node.DOCUMENT_NODE or
         node.nodeType == node.ELEMENT_NODE):
-        s = u''
-        for n in axes['descendant'](node):
+        text = []
+        pending = list(reversed(node.childNodes))
+        while pending:
+            n = pending.pop()
             if n.nodeType == n.TEXT_NODE:
-                s += n.data
-        return s
+                text.append(n.data)
+            elif n.childNodes:
+                pending.extend(reversed(n.childNodes))
+        return u''.join(text)
 
     elif node.nodeType == node.ATTRIBUTE_NODE:
         return node.value
@@ -38,6 +86,25 @@ def document_order(node):
     cmp(document_order(a), document_order(b)) will return -1, 0, or 1 if
     a is before, identical to, or after b in the document respectively.
 
+    Document order is the node's position in a pre-order numbering of its
+    document, computed once per document by DocumentIndex.  Nodes which
+    aren't in the index fall back to path_order().
+
+    """
+    index = document_index(node)
+    try:
+        return index.order[id(node)]
+    except KeyError:
+        # The document may have been modified since it was indexed.
+        index = document_index(node, rebuild=True)
+        try:
+            return index.order[id(node)]
+        except KeyError:
+            return path_order(node)
+
+def path_order(node):
+    """Compute a document order value for the node by walking the tree.
+
     We represent document order as a list of sibling indexes.  That is,
     the third child of the document node has an order of [2].  The first
     child of that node has an order of [2,0].
@@ -49,7 +116,7 @@ def document_order(node):
 
     # Attributes: parent-order + [-1, attribute-name]
     if node.nodeType == node.ATTRIBUTE_NODE:
-        order = document_order(node.ownerElement)
+        order = path_order(node.ownerElement)
         order.extend((-1, node.name))
         return order
 
@@ -65,10 +132,148 @@ def document_order(node):
         sib = sib.previousSibling
 
     # Order: parent-order + [sibling-position]
-    order = document_order(node.parentNode)
+    order = path_order(node.parentNode)
     order.append(sibpos)
     return order
 
+class DocumentIndex(object):
+    """Data about a document which is computed once and then shared by
+    every evaluation over the document.
+
+    order -- Maps id(node) to the node's position in document order, for
+             every node in the document, including attributes.  Attributes
+             come after their element and before its children, ordered by
+             name.
+    end   -- Maps id(node) to the position of the last node in the node's
+             subtree, so a node's descendants are exactly the nodes with
+             positions in (order, end].
+    names -- Maps (namespaceURI, localName) to the positions of the
+             elements with that name, and weak references to them, in
+             document order.  This is only built when first needed, by
+             descendants().
+
+    Nodes are keyed by id() and elements are weakly referenced so that the
+    index holds no references to the document, and can be dropped along
+    with it.  Indexes assume that the document isn't changed once it has
+    been queried; call invalidate_index() after changing one.
+
+    """
+    def __init__(self, root):
+        self.order = order = {}
+        self.end = end = {}
+        self.names = None
+        position = 0
+        pending = [(root, False)]
+        while pending:
+            node, visited = pending.pop()
+            if visited:
+                end[id(node)] = position - 1
+                continue
+            order[id(node)] = position
+            position += 1
+            attrs = node.attributes
+            if attrs:
+                for attr in sorted((attrs.item(i) for i in xrange(attrs.length)),
+                                   key=lambda attr: attr.name):
+                    order[id(attr)] = end[id(attr)] = position
+                    position += 1
+            pending.append((node, True))
+            children = node.childNodes
+            if children:
+                pending.extend((child, False) for child in reversed(children))
+
+    def index_names(self, root):
+        names = {}
+        order = self.order
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            if node.nodeType == node.ELEMENT_NODE:
+                try:
+                    positions, refs = names[(node.namespaceURI, node.localName)]
+                except KeyError:
+                    positions, refs = names[(node.namespaceURI, node.localName)] = ([], [])
+                positions.append(order[id(node)])
+                refs.append(weakref.ref(node))
+            children = node.childNodes
+            if children:
+                pending.extend(reversed(children))
+        self.names = names
+
+    def descendants(self, node, namespaceURI, localName, or_self=False):
+        """Return the elements named (namespaceURI, localName) among the
+        descendants of 'node' (and 'node' itself, if or_self is true), in
+        document order.
+
+        Returns None if 'node' isn't in the index.
+
+        """
+        try:
+            first = self.order[id(node)]
+            last = self.end[id(node)]
+        except KeyError:
+            return None
+        if self.names is None:
+            self.index_names(document_root(node))
+        try:
+            positions, refs = self.names[(namespaceURI, localName)]
+        except KeyError:
+            return []
+        if not or_self:
+            first += 1
+        nodes = [ref() for ref in
+                 refs[bisect.bisect_left(positions, first):
+                      bisect.bisect_right(positions, last)]]
+        if None in nodes:
+            return None
+        return nodes
+
+# DocumentIndexes, weakly keyed by the root of the document they describe.
+document_indexes = weakref.WeakKeyDictionary()
+
+def document_root(node):
+    """Return the document node (or the root node) of the tree containing
+    'node'.
+
+    """
+    if node.nodeType == node.DOCUMENT_NODE:
+        return node
+    if node.ownerDocument is not None:
+        return node.ownerDocument
+    if node.nodeType == node.ATTRIBUTE_NODE:
+        node = node.ownerElement
+    while node.parentNode is not None:
+        node = node.parentNode
+    return node
+
+def document_index(node, rebuild=False):
+    """Return the DocumentIndex for the document containing 'node'."""
+    root = document_root(node)
+    try:
+        index = document_indexes.get(root)
+        if index is None or rebuild:
+            index = document_indexes[root] = DocumentIndex(root)
+    except TypeError:
+        # The document can't be weakly referenced, so it can't be cached.
+        index = DocumentIndex(root)
+    return index
+
+# The contexts expressions are evaluated in when the caller gives none,
+# weakly keyed by document; see xpath.document_context().
+document_contexts = weakref.WeakKeyDictionary()
+
+def invalidate_index(node):
+    """Discard the DocumentIndex and the cached context for the document
+    containing 'node'.
+
+    """
+    root = document_root(node)
+    for cache in (document_indexes, document_contexts):
+        try:
+            del cache[root]
+        except (KeyError, TypeError):
+            pass
+
 #
 # Type functions, operating on the various XPath types.
 #
@@ -144,9 +349,73 @@ def numberp(v):
     return (not(isinstance(v, bool)) and
             (isinstance(v, int) or isinstance(v, float)))
 
+#
+# Static types.
+#
+# Expressions carry the type of the value they evaluate to in their 'type'
+# attribute, or None when it can only be known at runtime (e.g., for
+# variable references).  Compiled expressions use this to skip conversions
+# and type checks that can't fail.
+#
+
+NODESET = 'node-set'
+STRING = 'string'
+NUMBER = 'number'
+BOOLEAN = 'boolean'
+
+# The version of the pickled form of parsed expressions, which dumped
+# expression caches are stamped with; see XPath.dump_cache().  Bump it
+# whenever a change to the expression classes makes older pickles unusable.
+AST_VERSION = 1
+
+conversions = {
+    NODESET : nodeset,
+    STRING : string,
+    NUMBER : number,
+    BOOLEAN : boolean,
+}
+
+def coerce(f, type, to):
+    """Wrap the compiled expression 'f', of static type 'type', so that it
+    returns values of type 'to'.
+
+    """
+    if type == to:
+        return f
+    convert = conversions[to]
+    def coerced(node, pos, size, context):
+        return convert(f(node, pos, size, context))
+    return coerced
+
+#
+# Constant folding.
+#
+
+def fold_constant(expr):
+    """Evaluate 'expr', all of whose operands are literals, into a
+    LiteralExpr.
+
+    'expr' is returned unchanged if its evaluation raises an error, which
+    is left to be raised at runtime should the expression be reached, or
+    if its value can't be written back as an XPath literal.
+
+    """
+    try:
+        value = expr.evaluate(None, 1, 1, None)
+    except XPathError:
+        return expr
+    if numberp(value) and (value != value or
+                           value in (float('inf'), float('-inf'))):
+        return expr
+    if stringp(value) and "'" in value and '"' in value:
+        return expr
+    return LiteralExpr(value)
+
 class Expr(object):
     """Abstract base class for XPath expressions."""
 
+    type = None
+
     def evaluate(self, node, pos, size, context):
         """Evaluate the expression.
 
@@ -157,6 +426,39 @@ class Expr(object):
 
         """
 
+    def compile(self):
+        """Compile the expression.
+
+        Returns a function taking the same arguments as evaluate() and
+        returning the same value, built from closures specialized for this
+        expression rather than walking the expression tree.
+
+        """
+        return self.evaluate
+
+    def fold(self):
+        """Fold constant subexpressions.
+
+        Returns an equivalent expression in which each subexpression whose
+        value depends on neither the context nor the document, such as
+        1 + 1 or concat('a', 'b'), is replaced by a LiteralExpr of its
+        value.  This may be the expression itself, with its operands
+        folded in place.
+
+        """
+        return self
+
+    def compile_lazy(self):
+        """Compile a node-set expression for lazy evaluation.
+
+        Returns a function taking the same arguments as evaluate() and
+        returning an iterator over the nodes compile() would return, in
+        the same order, computed only as far as they are consumed.  Returns
+        None if the expression can't be evaluated lazily.
+
+        """
+        return None
+
 class BinaryOperatorExpr(Expr):
     """Base class for all binary operators."""
 
@@ -170,28 +472,82 @@ class BinaryOperatorExpr(Expr):
         return self.operate(self.left.evaluate(node, pos, size, context),
                             self.right.evaluate(node, pos, size, context))
 
+    def compile(self):
+        operate = self.operate
+        left = self.left.compile()
+        right = self.right.compile()
+        def evaluate(node, pos, size, context):
+            return operate(left(node, pos, size, context),
+                           right(node, pos, size, context))
+        return evaluate
+
+    def fold(self):
+        self.left = self.left.fold()
+        self.right = self.right.fold()
+        if (isinstance(self.left, LiteralExpr) and
+            isinstance(self.right, LiteralExpr)):
+            return fold_constant(self)
+        return self
+
     def __str__(self):
         return '(%s %s %s)' % (self.left, self.op, self.right)
 
 class AndExpr(BinaryOperatorExpr):
     """<x> and <y>"""
 
+    type = BOOLEAN
+
     def evaluate(self, node, pos, size, context):
         # Note that XPath boolean operations short-circuit.
         return (boolean(self.left.evaluate(node, pos, size, context) and
                 boolean(self.right.evaluate(node, pos, size, context))))
 
+    def compile(self):
+        left = coerce(self.left.compile(), self.left.type, BOOLEAN)
+        right = coerce(self.right.compile(), self.right.type, BOOLEAN)
+        def evaluate(node, pos, size, context):
+            return (left(node, pos, size, context) and
+                    right(node, pos, size, context))
+        return evaluate
+
+    def fold(self):
+        self.left = self.left.fold()
+        if (isinstance(self.left, LiteralExpr) and
+            not boolean(self.left.literal)):
+            # The right operand is never evaluated.
+            return LiteralExpr(False)
+        return BinaryOperatorExpr.fold(self)
+
 class OrExpr(BinaryOperatorExpr):
     """<x> or <y>"""
 
+    type = BOOLEAN
+
     def evaluate(self, node, pos, size, context):
         # Note that XPath boolean operations short-circuit.
         return (boolean(self.left.evaluate(node, pos, size, context) or
                 boolean(self.right.evaluate(node, pos, size, context))))
 
+    def compile(self):
+        left = coerce(self.left.compile(), self.left.type, BOOLEAN)
+        right = coerce(self.right.compile(), self.right.type, BOOLEAN)
+        def evaluate(node, pos, size, context):
+            return (left(node, pos, size, context) or
+                    right(node, pos, size, context))
+        return evaluate
+
+    def fold(self):
+        self.left = self.left.fold()
+        if isinstance(self.left, LiteralExpr) and boolean(self.left.literal):
+            # The right operand is never evaluated.
+            return LiteralExpr(True)
+        return BinaryOperatorExpr.fold(self)
+
 class EqualityExpr(BinaryOperatorExpr):
     """<x> = <y>, <x> != <y>, etc."""
 
+    type = BOOLEAN
+
     operators = {
         '='  : operator.eq,
         '!=' : operator.ne,
@@ -202,6 +558,9 @@ class EqualityExpr(BinaryOperatorExpr):
     }
 
     def operate(self, a, b):
+        if nodesetp(a) and nodesetp(b) and self.op in ('=', '!='):
+            return compare_values(self.op, string_values(a), string_values(b))
+
         if nodesetp(a):
             for node in a:
                 if self.operate(string_value(node), b):
@@ -227,6 +586,90 @@ class EqualityExpr(BinaryOperatorExpr):
         a, b = convert(a), convert(b)
         return self.operators[self.op](a, b)
 
+    def compile(self):
+        types = (self.left.type, self.right.type)
+        if types == (NODESET, NODESET) and self.op in ('=', '!='):
+            op = self.op
+            left = compile_string_values(self.left)
+            right = compile_string_values(self.right)
+            def evaluate(node, pos, size, context):
+                return compare_values(op, left(node, pos, size, context),
+                                      right(node, pos, size, context))
+            return evaluate
+        if None in types or NODESET in types:
+            return BinaryOperatorExpr.compile(self)
+
+        # Neither operand is a node-set, so the conversion applied to both
+        # is known statically.
+        if self.op in ('=', '!='):
+            if BOOLEAN in types:
+                to = BOOLEAN
+            elif NUMBER in types:
+                to = NUMBER
+            else:
+                to = STRING
+        else:
+            to = NUMBER
+        op = self.operators[self.op]
+        left = coerce(self.left.compile(), self.left.type, to)
+        right = coerce(self.right.compile(), self.right.type, to)
+        def evaluate(node, pos, size, context):
+            return op(left(node, pos, size, context),
+                      right(node, pos, size, context))
+        return evaluate
+
+def string_values(nodes):
+    """Return the set of the string-values of the nodes in a node-set."""
+    return set([string_value(node) for node in nodes])
+
+def compare_values(op, a, b):
+    """Compare two node-sets, given as the sets of their string-values,
+    with '=' or '!='.
+
+    """
+    if op == '=':
+        return not a.isdisjoint(b)
+    # Some pair of values differs unless both sets hold the same single
+    # value.
+    return bool(a and b) and len(a | b) > 1
+
+def compile_string_values(expr):
+    """Compile a node-set expression into a function returning the set of
+    the string-values of the nodes it selects.
+
+    The value of an absolute path only depends on the document and the
+    context's variables and namespaces, so within an evaluation() it is
+    only computed once per document and context. Nested evaluations run
+    with a context of their own whenever they pass different ones.
+
+    """
+    f = expr.compile()
+    if not isinstance(expr, AbsolutePathExpr):
+        def evaluate(node, pos, size, context):
+            return string_values(f(node, pos, size, context))
+        return evaluate
+    def evaluate(node, pos, size, context):
+        nodesets = evaluation_state.nodesets
+        if nodesets is None:
+            return string_values(f(node, pos, size, context))
+        # The context is kept in the key, so its id can't be reused.
+        key = (expr, node.ownerDocument or node, context)
+        try:
+            return nodesets[key]
+        except KeyError:
+            values = nodesets[key] = string_values(f(node, pos, size, context))
+            return values
+    return evaluate
+
+def converted(f, convert):
+    """Wrap the compiled expression 'f' to pass its values through the
+    conversion function 'convert'.
+
+    """
+    def evaluate(node, pos, size, context):
+        return convert(f(node, pos, size, context))
+    return evaluate
+
 def divop(x, y):
     try:
         return x / y
@@ -249,12 +692,25 @@ class ArithmeticalExpr(BinaryOperatorExpr):
         'mod' : math.fmod
     }
 
+    type = NUMBER
+
     def operate(self, a, b):
         return self.operators[self.op](number(a), number(b))
 
+    def compile(self):
+        op = self.operators[self.op]
+        left = coerce(self.left.compile(), self.left.type, NUMBER)
+        right = coerce(self.right.compile(), self.right.type, NUMBER)
+        def evaluate(node, pos, size, context):
+            return op(left(node, pos, size, context),
+                      right(node, pos, size, context))
+        return evaluate
+
 class UnionExpr(BinaryOperatorExpr):
     """<x> | <y>"""
 
+    type = NODESET
+
     def operate(self, a, b):
         if not nodesetp(a) or not nodesetp(b):
             raise XPathTypeError("union operand is not a node-set")
@@ -262,33 +718,74 @@ class UnionExpr(BinaryOperatorExpr):
         # Need to sort the result to preserve document order.
         return sorted(set(chain(a, b)), key=document_order)
 
+    def compile(self):
+        if self.left.type != NODESET or self.right.type != NODESET:
+            return BinaryOperatorExpr.compile(self)
+        left = self.left.compile()
+        right = self.right.compile()
+        def evaluate(node, pos, size, context):
+            return sorted(set(chain(left(node, pos, size, context),
+                                    right(node, pos, size, context))),
+                          key=document_order)
+        return evaluate
+
 class NegationExpr(Expr):
     """- <x>"""
 
+    type = NUMBER
+
     def __init__(self, expr):
         self.expr = expr
 
     def evaluate(self, node, pos, size, context):
         return -number(self.expr.evaluate(node, pos, size, context))
 
+    def compile(self):
+        expr = coerce(self.expr.compile(), self.expr.type, NUMBER)
+        def evaluate(node, pos, size, context):
+            return -expr(node, pos, size, context)
+        return evaluate
+
+    def fold(self):
+        self.expr = self.expr.fold()
+        if isinstance(self.expr, LiteralExpr):
+            return fold_constant(self)
+        return self
+
     def __str__(self):
         return '(-%s)' % self.expr
 
 class LiteralExpr(Expr):
-    """Literals--either numbers or strings."""
+    """Literals--either numbers or strings, or booleans from constant
+    folding.
 
+    """
     def __init__(self, literal):
         self.literal = literal
+        if numberp(literal):
+            self.type = NUMBER
+        elif booleanp(literal):
+            self.type = BOOLEAN
+        else:
+            self.type = STRING
 
     def evaluate(self, node, pos, size, context):
         return self.literal
 
+    def compile(self):
+        literal = self.literal
+        def evaluate(node, pos, size, context):
+            return literal
+        return evaluate
+
     def __str__(self):
         if stringp(self.literal):
             if "'" in self.literal:
                 return '"%s"' % self.literal
             else:
                 return "'%s'" % self.literal
+        if booleanp(self.literal):
+            return '%s()' % string(self.literal)
         return string(self.literal)
 
 class VariableReference(Expr):
@@ -317,21 +814,213 @@ class VariableReference(Expr):
         else:
             return '$%s:%s' % (self.prefix, self.name)
 
+def function(minargs, maxargs, implicit=False, first=False, convert=None,
+             returns=None, contextual=False, positional=False,
+             vectorized=False):
+    """Function decorator.
+
+    minargs -- Minimum number of arguments taken by the function.
+    maxargs -- Maximum number of arguments taken by the function.
+    implicit -- True for functions which operate on a nodeset consisting
+                of the current context node when passed no argument.
+                (e.g., string() and number().)
+    first -- True for functions which take the first node of a node-set
+             as their first argument.
+    convert -- When non-None, a function used to filter function arguments,
+               or a sequence of them, one per argument, the last of which
+               also applies to any further arguments.
+    returns -- The static type of the function's result, if known.
+    contextual -- True for functions whose value depends on the context,
+                  not only on their arguments.
+    positional -- True for functions whose value depends on the context
+                  position or size.
+    vectorized -- True for functions taking a list of context nodes and a
+                  list of values for each argument; see
+                  register_function().
+    """
+    def decorator(f):
+        def new_f(self, node, pos, size, context):
+            if implicit and len(self.args) == 0:
+                args = [[node]]
+            else:
+                args = [x.evaluate(node, pos, size, context)
+                        for x in self.args]
+            if first:
+                args[0] = nodeset(args[0])
+                if len(args[0]) > 0:
+                    args[0] = args[0][0]
+                else:
+                    args[0] = None
+            if convert is not None:
+                args = [x if c is None else c(x) for c, x in
+                        izip(argument_conversions(convert, len(args)), args)]
+            if vectorized:
+                return f(self, [node], context, *[[x] for x in args])[0]
+            return f(self, node, pos, size, context, *args)
+
+        new_f.minargs = minargs
+        new_f.maxargs = maxargs
+        new_f.implicit = implicit
+        new_f.first = first
+        new_f.convert = convert
+        new_f.returns = returns
+        new_f.contextual = contextual
+        new_f.positional = positional
+        new_f.vectorized = vectorized
+        new_f.implementation = f
+        new_f.__name__ = f.__name__
+        new_f.__doc__ = f.__doc__
+        return new_f
+    return decorator
+
+def argument_conversions(convert, count):
+    """Return the conversion a function declared with 'convert' applies to
+    each of 'count' arguments, or None for arguments it doesn't convert.
+
+    """
+    if convert is None:
+        return [None] * count
+    if callable(convert):
+        return [convert] * count
+    convert = list(convert)
+    return (convert + convert[-1:] * count)[:count]
+
 class Function(Expr):
-    """Functions."""
+    """Function calls.
+
+    The implementation of the function is looked up by name, and the
+    number of arguments checked, once, when the call is parsed.
 
+    """
     def __init__(self, name, args):
         self.name = name
         self.args = args
-        self.evaluate = getattr(self, 'f_%s' % name.replace('-', '_'), None)
-        if self.evaluate is None:
+        self.function = functions.get(name)
+        if self.function is None:
             raise XPathUnknownFunctionError, 'unknown function "%s()"' % name
 
-        if len(self.args) < self.evaluate.minargs:
+        if len(self.args) < self.function.minargs:
             raise XPathTypeError, 'too few arguments for "%s()"' % name
-        if (self.evaluate.maxargs is not None and
-            len(self.args) > self.evaluate.maxargs):
+        if (self.function.maxargs is not None and
+            len(self.args) > self.function.maxargs):
             raise XPathTypeError, 'too many arguments for "%s()"' % name
+        self.type = self.function.returns
+
+    def evaluate(self, node, pos, size, context):
+        return self.function(self, node, pos, size, context)
+
+    def __getstate__(self):
+        # The implementation is pickled by name.
+        state = self.__dict__.copy()
+        del state['function']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.function = functions.get(self.name)
+        if self.function is None:
+            raise XPathUnknownFunctionError, 'unknown function "%s()"' % self.name
+
+    def fold(self):
+        self.args = [x.fold() for x in self.args]
+        if (not self.function.contextual and
+            (self.args or not self.function.implicit) and
+            not [x for x in self.args if not isinstance(x, LiteralExpr)]):
+            return fold_constant(self)
+        return self
+
+    def compile_args(self):
+        """Compile the arguments of the call into a list of functions
+        returning the values the implementation takes.
+
+        Conversions are only applied to arguments whose static type
+        doesn't make them unnecessary, and constant arguments are
+        converted once, here.
+
+        """
+        f = self.function
+        if f.implicit and len(self.args) == 0:
+            def implicit(node, pos, size, context):
+                return [node]
+            args = [(implicit, NODESET)]
+            exprs = [None]
+        else:
+            args = [(x.compile(), x.type) for x in self.args]
+            exprs = self.args
+
+        if f.first:
+            nodes_arg = coerce(args[0][0], args[0][1], NODESET)
+            def first(node, pos, size, context):
+                nodes = nodes_arg(node, pos, size, context)
+                if len(nodes) > 0:
+                    return nodes[0]
+                return None
+            args[0] = (first, None)
+
+        for i, convert in enumerate(argument_conversions(f.convert, len(args))):
+            if convert is None:
+                continue
+            if isinstance(exprs[i], LiteralExpr) and not (f.first and i == 0):
+                try:
+                    value = convert(exprs[i].literal)
+                except XPathError:
+                    pass
+                else:
+                    args[i] = (LiteralExpr(value).compile(), None)
+                    continue
+            arg, type = args[i]
+            if type is None or conversions.get(type) is not convert:
+                args[i] = (converted(arg, convert), None)
+        return [arg for arg, type in args]
+
+    def compile(self):
+        impl = self.function.implementation
+        args = self.compile_args()
+
+        if self.function.vectorized:
+            def evaluate(node, pos, size, context):
+                return impl(self, [node], context,
+                            *[[x(node, pos, size, context)] for x in args])[0]
+            return evaluate
+
+        # Specialize calls for the common numbers of arguments.
+        if len(args) == 0:
+            def evaluate(node, pos, size, context):
+                return impl(self, node, pos, size, context)
+        elif len(args) == 1:
+            a = args[0]
+            def evaluate(node, pos, size, context):
+                return impl(self, node, pos, size, context,
+                            a(node, pos, size, context))
+        elif len(args) == 2:
+            a, b = args
+            def evaluate(node, pos, size, context):
+                return impl(self, node, pos, size, context,
+                            a(node, pos, size, context),
+                            b(node, pos, size, context))
+        else:
+            def evaluate(node, pos, size, context):
+                return impl(self, node, pos, size, context,
+                            *[x(node, pos, size, context) for x in args])
+        return evaluate
+
+    def compile_batch(self):
+        """Compile a call of a vectorized function into a function taking a
+        node-set and a context, and returning the list of the values of the
+        call for each node, from a single call of the implementation.
+
+        """
+        impl = self.function.implementation
+        args = self.compile_args()
+        def evaluate(nodes, context):
+            if not nodes:
+                return []
+            size = len(nodes)
+            columns = [[arg(node, i, size, context)
+                        for i, node in izip(count(1), nodes)]
+                       for arg in args]
+            return impl(self, nodes, context, *columns)
+        return evaluate
 
     #
     # XPath functions are implemented by methods of the Function class.
@@ -341,55 +1030,21 @@ class Function(Expr):
     # parameters.
     #
 
-    def function(minargs, maxargs, implicit=False, first=False, convert=None):
-        """Function decorator.
-
-        minargs -- Minimum number of arguments taken by the function.
-        maxargs -- Maximum number of arguments taken by the function.
-        implicit -- True for functions which operate on a nodeset consisting
-                    of the current context node when passed no argument.
-                    (e.g., string() and number().)
-        convert -- When non-None, a function used to filter function arguments.
-        """
-        def decorator(f):
-            def new_f(self, node, pos, size, context):
-                if implicit and len(self.args) == 0:
-                    args = [[node]]
-                else:
-                    args = [x.evaluate(node, pos, size, context)
-                            for x in self.args]
-                if first:
-                    args[0] = nodeset(args[0])
-                    if len(args[0]) > 0:
-                        args[0] = args[0][0]
-                    else:
-                        args[0] = None
-                if convert is not None:
-                    args = [convert(x) for x in args]
-                return f(self, node, pos, size, context, *args)
-
-            new_f.minargs = minargs
-            new_f.maxargs = maxargs
-            new_f.__name__ = f.__name__
-            new_f.__doc__ = f.__doc__
-            return new_f
-        return decorator
-
     # Node Set Functions
 
-    @function(0, 0)
+    @function(0, 0, returns=NUMBER, contextual=True, positional=True)
     def f_last(self, node, pos, size, context):
         return size
 
-    @function(0, 0)
+    @function(0, 0, returns=NUMBER, contextual=True, positional=True)
     def f_position(self, node, pos, size, context):
         return pos
 
-    @function(1, 1, convert=nodeset)
+    @function(1, 1, convert=nodeset, returns=NUMBER)
     def f_count(self, node, pos, size, context, nodes):
         return len(nodes)
 
-    @function(1, 1)
+    @function(1, 1, returns=NODESET, contextual=True)
     def f_id(self, node, pos, size, context, arg):
         if nodesetp(arg):
             ids = (string_value(x) for x in arg)
@@ -399,7 +1054,7 @@ class Function(Expr):
             node = node.ownerDocument
         return list(filter(None, (node.getElementById(id) for id in ids)))
 
-    @function(0, 1, implicit=True, first=True)
+    @function(0, 1, implicit=True, first=True, returns=STRING)
     def f_local_name(self, node, pos, size, context, argnode):
         if argnode is None:
             return ''
@@ -410,13 +1065,13 @@ class Function(Expr):
             return argnode.target
         return ''
 
-    @function(0, 1, implicit=True, first=True)
+    @function(0, 1, implicit=True, first=True, returns=STRING)
     def f_namespace_uri(self, node, pos, size, context, argnode):
         if argnode is None:
             return ''
         return argnode.namespaceURI
 
-    @function(0, 1, implicit=True, first=True)
+    @function(0, 1, implicit=True, first=True, returns=STRING)
     def f_name(self, node, pos, size, context, argnode):
         if argnode is None:
             return ''
@@ -430,40 +1085,39 @@ class Function(Expr):
 
     # String Functions
 
-    @function(0, 1, implicit=True, convert=string)
+    @function(0, 1, implicit=True, convert=string, returns=STRING)
     def f_string(self, node, pos, size, context, arg):
         return arg
 
-    @function(2, None, convert=string)
+    @function(2, None, convert=string, returns=STRING)
     def f_concat(self, node, pos, size, context, *args):
         return ''.join((x for x in args))
 
-    @function(2, 2, convert=string)
+    @function(2, 2, convert=string, returns=BOOLEAN)
     def f_starts_with(self, node, pos, size, context, a, b):
         return a.startswith(b)
 
-    @function(2, 2, convert=string)
+    @function(2, 2, convert=string, returns=BOOLEAN)
     def f_contains(self, node, pos, size, context, a, b):
         return b in a
 
-    @function(2, 2, convert=string)
+    @function(2, 2, convert=string, returns=STRING)
     def f_substring_before(self, node, pos, size, context, a, b):
         try:
             return a[0:a.index(b)]
         except ValueError:
             return ''
 
-    @function(2, 2, convert=string)
+    @function(2, 2, convert=string, returns=STRING)
     def f_substring_after(self, node, pos, size, context, a, b):
         try:
             return a[a.index(b)+len(b):]
         except ValueError:
             return ''
 
-    @function(2, 3)
+    @function(2, 3, convert=(string, number), returns=STRING)
     def f_substring(self, node, pos, size, context, s, start, count=None):
-        s = string(s)
-        start = round(number(start))
+        start = round(start)
         if start != start:
             # Catch NaN
             return ''
@@ -471,7 +1125,7 @@ class Function(Expr):
         if count is None:
             end = len(s) + 1
         else:
-            end = start + round(number(count))
+            end = start + round(count)
             if end != end:
                 # Catch NaN
                 return ''
@@ -486,15 +1140,15 @@ class Function(Expr):
             return ''
         return s[int(start)-1:int(end)-1]
 
-    @function(0, 1, implicit=True, convert=string)
+    @function(0, 1, implicit=True, convert=string, returns=NUMBER)
     def f_string_length(self, node, pos, size, context, s):
         return len(s)
 
-    @function(0, 1, implicit=True, convert=string)
+    @function(0, 1, implicit=True, convert=string, returns=STRING)
     def f_normalize_space(self, node, pos, size, context, s):
         return re.sub(r'\s+', ' ', s.strip())
 
-    @function(3, 3, convert=lambda x: unicode(string(x)))
+    @function(3, 3, convert=lambda x: unicode(string(x)), returns=STRING)
     def f_translate(self, node, pos, size, context, s, source, target):
         # str.translate() and unicode.translate() are completely different.
         # The translate() arguments are coerced to unicode.
@@ -512,23 +1166,23 @@ class Function(Expr):
 
     # Boolean functions
 
-    @function(1, 1, convert=boolean)
+    @function(1, 1, convert=boolean, returns=BOOLEAN)
     def f_boolean(self, node, pos, size, context, b):
         return b
 
-    @function(1, 1, convert=boolean)
+    @function(1, 1, convert=boolean, returns=BOOLEAN)
     def f_not(self, node, pos, size, context, b):
         return not b
 
-    @function(0, 0)
+    @function(0, 0, returns=BOOLEAN)
     def f_true(self, node, pos, size, context):
         return True
 
-    @function(0, 0)
+    @function(0, 0, returns=BOOLEAN)
     def f_false(self, node, pos, size, context):
         return False
 
-    @function(1, 1, convert=string)
+    @function(1, 1, convert=string, returns=BOOLEAN, contextual=True)
     def f_lang(self, node, pos, size, context, s):
         s = s.lower()
         for n in axes['ancestor-or-self'](node):
@@ -541,23 +1195,23 @@ class Function(Expr):
 
     # Number functions
 
-    @function(0, 1, implicit=True, convert=number)
+    @function(0, 1, implicit=True, convert=number, returns=NUMBER)
     def f_number(self, node, pos, size, context, n):
         return n
 
-    @function(1, 1, convert=nodeset)
+    @function(1, 1, convert=nodeset, returns=NUMBER)
     def f_sum(self, node, pos, size, context, nodes):
         return sum((number(string_value(x)) for x in nodes))
 
-    @function(1, 1, convert=number)
+    @function(1, 1, convert=number, returns=NUMBER)
     def f_floor(self, node, pos, size, context, n):
         return math.floor(n)
 
-    @function(1, 1, convert=number)
+    @function(1, 1, convert=number, returns=NUMBER)
     def f_ceiling(self, node, pos, size, context, n):
         return math.ceil(n)
 
-    @function(1, 1, convert=number)
+    @function(1, 1, convert=number, returns=NUMBER)
     def f_round(self, node, pos, size, context, n):
         # XXX round(-0.0) should be -0.0, not 0.0.
         # XXX round(-1.5) should be -1.0, not -2.0.
@@ -566,6 +1220,45 @@ class Function(Expr):
     def __str__(self):
         return '%s(%s)' % (self.name, ', '.join((str(x) for x in self.args)))
 
+# XPath functions by name: the methods of Function implementing the
+# built-in functions, and those added by register_function().
+functions = dict((name[2:].replace('_', '-'), f)
+                 for name, f in vars(Function).items()
+                 if name.startswith('f_'))
+
+builtin_functions = frozenset(functions)
+
+def register_function(name, implementation, minargs=0, maxargs=None,
+                      implicit=False, first=False, convert=None, returns=None,
+                      pure=False, vectorized=False):
+    """Make 'implementation' callable as name() from expressions parsed
+    from now on.
+
+    The implementation is called like the methods of Function which
+    implement the built-in functions: with the Function expression, the
+    context node, position and size, the context, and the arguments of the
+    call, which 'implicit', 'first' and 'convert' describe as for the
+    function decorator.  Calls are compiled in the same way too.  'returns'
+    is the static type of the result, if known.
+
+    A vectorized implementation is instead called with the Function
+    expression, a list of context nodes, the context, and for each
+    argument the list of its values for each of the nodes, and returns the
+    list of its values for each node.  As a predicate, it is called once
+    for all the nodes being filtered.
+
+    Unless the function is declared pure, meaning that its value depends
+    on nothing but its arguments, it is never folded into a constant, and
+    it is taken to depend on the context position.
+
+    """
+    if name in builtin_functions:
+        raise ValueError('%s() is a built-in function' % name)
+    functions[name] = function(minargs, maxargs, implicit, first, convert,
+                               returns, contextual=not pure,
+                               positional=not pure,
+                               vectorized=vectorized)(implementation)
+
 #
 # XPath axes.
 #
@@ -596,9 +1289,16 @@ def make_axes():
 
     @axisfn()
     def descendant(node):
-        for child in node.childNodes:
-            for node in descendant_or_self(child):
+        # A stack of iterators over the children of each open node.
+        pending = [iter(node.childNodes)]
+        while pending:
+            for node in pending[-1]:
                 yield node
+                if node.childNodes:
+                    pending.append(iter(node.childNodes))
+                    break
+            else:
+                pending.pop()
 
     @axisfn()
     def parent(node):
@@ -628,8 +1328,10 @@ def make_axes():
         while node is not None:
             while node.nextSibling is not None:
                 node = node.nextSibling
-                for n in descendant_or_self(node):
-                    yield n
+                yield node
+                if node.childNodes:
+                    for n in descendant(node):
+                        yield n
             node = node.parentNode
 
     @axisfn(reverse=True)
@@ -637,9 +1339,19 @@ def make_axes():
         while node is not None:
             while node.previousSibling is not None:
                 node = node.previousSibling
-                # Could be more efficient here.
-                for n in reversed(list(descendant_or_self(node))):
-                    yield n
+                if not node.childNodes:
+                    yield node
+                    continue
+                # Each subtree is walked in reverse document order: a
+                # node's children, last first, and then the node itself.
+                pending = [(node, False)]
+                while pending:
+                    n, visited = pending.pop()
+                    if visited or not n.childNodes:
+                        yield n
+                    else:
+                        pending.append((n, True))
+                        pending.extend((child, False) for child in n.childNodes)
             node = node.parentNode
 
     @axisfn(principal_node_type=xml.dom.Node.ATTRIBUTE_NODE)
@@ -660,9 +1372,9 @@ def make_axes():
     @axisfn()
     def descendant_or_self(node):
         yield node
-        for child in node.childNodes:
-            for node in descendant_or_self(child):
-                yield node
+        if node.childNodes:
+            for n in descendant(node):
+                yield n
 
     @axisfn(reverse=True)
     def ancestor_or_self(node):
@@ -680,28 +1392,43 @@ def merge_into_nodeset(target, source):
     document order to begin with.
 
     """
+    if len(source) == 0:
+        return
     if len(target) == 0:
         target.extend(source)
         return
 
-    source = [n for n in source if n not in target]
-    if len(source) == 0:
-        return
-
     # If the last node in the target set comes before the first node in the
-    # source set, then we can just concatenate the sets.  Otherwise, we
-    # will need to sort.  (We could also check to see if the last node in
-    # the source set comes before the first node in the target set, but this
-    # situation is very unlikely in practice.)
+    # source set, then we can just concatenate the sets.  Otherwise, the
+    # sets are merged in a single pass, dropping nodes that are in both.
     if document_order(target[-1]) < document_order(source[0]):
         target.extend(source)
-    else:
-        target.extend(source)
-        target.sort(key=document_order)
+        return
+
+    merged = []
+    target_keys = [document_order(n) for n in target]
+    source_keys = [document_order(n) for n in source]
+    i = j = 0
+    while i < len(target) and j < len(source):
+        if target_keys[i] < source_keys[j]:
+            merged.append(target[i])
+            i += 1
+        elif source_keys[j] < target_keys[i]:
+            merged.append(source[j])
+            j += 1
+        else:
+            merged.append(target[i])
+            i += 1
+            j += 1
+    merged.extend(target[i:])
+    merged.extend(source[j:])
+    target[:] = merged
 
 class AbsolutePathExpr(Expr):
     """Absolute location paths."""
 
+    type = NODESET
+
     def __init__(self, path):
         self.path = path
 
@@ -712,6 +1439,40 @@ class AbsolutePathExpr(Expr):
             return [node]
         return self.path.evaluate(node, 1, 1, context)
 
+    def compile(self):
+        if self.path is None:
+            def evaluate(node, pos, size, context):
+                if node.nodeType != node.DOCUMENT_NODE:
+                    node = node.ownerDocument
+                return [node]
+            return evaluate
+        path = coerce(self.path.compile(), self.path.type, NODESET)
+        def evaluate(node, pos, size, context):
+            if node.nodeType != node.DOCUMENT_NODE:
+                node = node.ownerDocument
+            return path(node, 1, 1, context)
+        return evaluate
+
+    def fold(self):
+        if self.path is not None:
+            self.path = self.path.fold()
+        return self
+
+    def compile_lazy(self):
+        if self.path is None:
+            path = None
+        else:
+            path = self.path.compile_lazy()
+            if path is None:
+                return None
+        def evaluate(node, pos, size, context):
+            if node.nodeType != node.DOCUMENT_NODE:
+                node = node.ownerDocument
+            if path is None:
+                return iter([node])
+            return path(node, 1, 1, context)
+        return evaluate
+
     def __str__(self):
         return '/%s' % (self.path or '')
 
@@ -721,6 +1482,14 @@ class PathExpr(Expr):
     def __init__(self, steps):
         self.steps = steps
 
+    @property
+    def type(self):
+        # The parser adds steps after construction, so this can't be
+        # worked out up front.
+        if len(self.steps) > 1:
+            return NODESET
+        return self.steps[0].type
+
     def evaluate(self, node, pos, size, context):
         # The first step in the path is evaluated in the current context.
         # If this is the only step in the path, the return value is
@@ -743,9 +1512,299 @@ class PathExpr(Expr):
 
         return result
 
+    def compile(self):
+        if len(self.steps) == 1:
+            return self.steps[0].compile()
+        if is_child_path(self.steps):
+            return compile_child_path(self.steps)
+        path = descendant_steps(self.steps)
+        if len(path) == 1:
+            return path[0].compile()
+        first = coerce(path[0].compile(), path[0].type, NODESET)
+        steps = [coerce(step.compile(), step.type, NODESET)
+                 for step in path[1:]]
+        def evaluate(node, pos, size, context):
+            result = first(node, pos, size, context)
+            for step in steps:
+                aggregate = []
+                size = len(result)
+                for i in xrange(size):
+                    merge_into_nodeset(aggregate,
+                                       step(result[i], i+1, size, context))
+                result = aggregate
+            return result
+        return evaluate
+
+    def fold(self):
+        self.steps = [step.fold() for step in self.steps]
+        if len(self.steps) == 1 and isinstance(self.steps[0], LiteralExpr):
+            # The parser wraps primary expressions in a single step path,
+            # which a constant doesn't need.
+            return self.steps[0]
+        return self
+
+    def compile_lazy(self):
+        path = descendant_steps(self.steps)
+        if not lazy_path(path):
+            return None
+        steps = [step.compile_lazy() for step in path]
+        if None in steps:
+            return None
+        first = steps.pop(0)
+        def evaluate(node, pos, size, context):
+            result = first(node, pos, size, context)
+            for step in steps:
+                result = lazy_step(step, result, context)
+            return result
+        return evaluate
+
     def __str__(self):
         return '/'.join((str(s) for s in self.steps))
 
+class PathTrie(object):
+    """A step in the trie built by compile_many().
+
+    step        -- The compiled step, or None at the root.
+    state       -- The state of the node-set selected by the path up to
+                   here; see step_transition().
+    concatenate -- True if the step's results need no merging.
+    children    -- Maps the string form of each following step to its
+                   trie.
+    names       -- The names of the paths ending with this step.
+
+    """
+    def __init__(self, step=None, state='flat', concatenate=True):
+        self.step = step
+        self.state = state
+        self.concatenate = concatenate
+        self.children = {}
+        self.names = []
+
+def compile_many(exprs):
+    """Compile a dict of names to parsed expressions into one function
+    taking a node and a context, and returning a dict of the names to the
+    values of the expressions.
+
+    Location paths are merged into a trie of their steps, so that a step
+    shared by several paths--along with all the steps before it--is only
+    evaluated once.  Other expressions are evaluated separately.
+
+    """
+    relative = PathTrie()
+    absolute = PathTrie()
+    others = {}
+    for name, expr in exprs.items():
+        trie = relative
+        path = expr
+        if isinstance(expr, AbsolutePathExpr):
+            trie = absolute
+            path = expr.path
+        if path is None:
+            trie.names.append(name)
+            continue
+        if not (isinstance(path, PathExpr) and
+                [s for s in path.steps
+                 if isinstance(s, (AxisStep, PredicateList))] == path.steps):
+            others[name] = expr.compile()
+            continue
+        for step in descendant_steps(path.steps):
+            key = str(step)
+            try:
+                trie = trie.children[key]
+            except KeyError:
+                concatenate, state = step_transition(
+                    step, trie.state, trie.step is None)
+                child = PathTrie(step.compile(), state, concatenate)
+                trie.children[key] = child
+                trie = child
+        trie.names.append(name)
+
+    def evaluate(node, context):
+        results = {}
+        for name, f in others.items():
+            results[name] = f(node, 1, 1, context)
+        if node.nodeType == node.DOCUMENT_NODE:
+            document = node
+        else:
+            document = node.ownerDocument
+        pending = [(relative, [node]), (absolute, [document])]
+        while pending:
+            trie, nodes = pending.pop()
+            for name in trie.names:
+                results[name] = list(nodes)
+            for child in trie.children.values():
+                step = child.step
+                size = len(nodes)
+                if child.concatenate:
+                    aggregate = [n for i in xrange(size)
+                                 for n in step(nodes[i], i+1, size, context)]
+                else:
+                    aggregate = []
+                    for i in xrange(size):
+                        merge_into_nodeset(aggregate,
+                                           step(nodes[i], i+1, size, context))
+                pending.append((child, aggregate))
+        return results
+    return evaluate
+
+def lazy_step(step, nodes, context):
+    """Lazily apply a step compiled by compile_lazy() to each of 'nodes'."""
+    for node in nodes:
+        for n in step(node, 1, 1, context):
+            yield n
+
+def lazy_path(steps):
+    """Return True if the node-set selected by the steps is the
+    concatenation, in order, of the nodes selected by each step from each
+    node selected by the step before, so that no merging is needed and the
+    path can be evaluated lazily.
+
+    """
+    state = 'flat'
+    for i, step in enumerate(steps):
+        concatenate, state = step_transition(step, state, i == 0)
+        if not concatenate:
+            return False
+    return True
+
+def step_transition(step, state, first):
+    """Return whether the nodes 'step' selects from each node of a node-set
+    can simply be concatenated, and the state of the resulting node-set.
+
+    A node-set is 'flat' if none of its nodes are inside another: their
+    children or descendants are then disjoint and in document order.  It
+    is 'nested' otherwise, or 'attributes' if it only holds attributes.
+    Attributes can follow anything, as a node's attributes come directly
+    after it, but only self can follow attributes.  The first step is
+    taken from a single node.
+
+    """
+    if isinstance(step, PredicateList):
+        step = step.expr
+    if not isinstance(step, AxisStep):
+        return False, 'nested'
+    axis = step.axis.__name__
+    if axis == 'self':
+        return True, state
+    if axis == 'attribute':
+        return state != 'attributes', 'attributes'
+    if first and axis in ('child', 'following-sibling'):
+        return True, 'flat'
+    if first:
+        return True, 'nested'
+    if state == 'flat' and axis == 'child':
+        return True, 'flat'
+    if state == 'flat' and axis in ('descendant', 'descendant-or-self'):
+        return True, 'nested'
+    return False, 'nested'
+
+def descendant_steps(steps):
+    """Return the steps with each descendant-or-self::node()/child::x pair
+    (the expansion of //x) replaced by the equivalent descendant::x, which
+    is a single walk rather than one per descendant.
+
+    A predicate on the child step is only carried over when it doesn't
+    depend on the position of nodes, as positions are counted among the
+    children of each node, not among all descendants.
+
+    """
+    result = []
+    for step in steps:
+        previous = result and result[-1]
+        if (isinstance(previous, AxisStep) and
+            previous.axis is axes['descendant-or-self'] and
+            isinstance(previous.test, AnyKindTest)):
+            if (isinstance(step, AxisStep) and
+                step.axis is axes['child'] and
+                isinstance(step.test, NameTest)):
+                result[-1] = AxisStep('descendant', step.test)
+                continue
+            if (isinstance(step, PredicateList) and
+                isinstance(step.expr, AxisStep) and
+                step.expr.axis is axes['child'] and
+                isinstance(step.expr.test, NameTest) and
+                not [p for p in step.predicates if uses_position(p)]):
+                result[-1] = PredicateList(
+                    AxisStep('descendant', step.expr.test),
+                    step.predicates, 'descendant')
+                continue
+        result.append(step)
+    return result
+
+def uses_position(expr):
+    """Return True if the value of a predicate may depend on the position
+    of the node it is applied to.
+
+    """
+    if expr.type not in (BOOLEAN, STRING, NODESET):
+        return True
+    pending = [expr]
+    while pending:
+        expr = pending.pop()
+        if isinstance(expr, Function) and expr.function.positional:
+            return True
+        for value in vars(expr).values():
+            if isinstance(value, Expr):
+                pending.append(value)
+            elif isinstance(value, list):
+                pending.extend(v for v in value if isinstance(v, Expr))
+    return False
+
+def is_child_path(steps):
+    """Return True if the steps are predicate-free name tests along the
+    child axis, optionally followed by a name test along the attribute
+    axis--e.g., a/b/c or a/b/@c.
+
+    """
+    for step in steps[:-1]:
+        if not (isinstance(step, AxisStep) and
+                isinstance(step.test, NameTest) and
+                step.axis is axes['child']):
+            return False
+    last = steps[-1]
+    return (isinstance(last, AxisStep) and
+            isinstance(last.test, NameTest) and
+            (last.axis is axes['child'] or last.axis is axes['attribute']))
+
+def compile_child_path(steps):
+    """Compile a path accepted by is_child_path() into a direct walk of
+    childNodes.
+
+    The children of each node in a node-set which is in document order are
+    themselves in document order, and distinct nodes have distinct
+    children, so the node-sets never need merging.
+
+    """
+    child = axes['child']
+    ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+    tests = [(step.test, step.test.localName) for step in steps]
+    if steps[-1].axis is axes['attribute']:
+        attribute_test = tests.pop()
+    else:
+        attribute_test = None
+
+    def evaluate(node, pos, size, context):
+        result = [node]
+        for test, localName in tests:
+            if not result:
+                return result
+            namespaceURI = test.namespace(child, context)
+            result = [n for parent in result for n in parent.childNodes
+                      if n.nodeType == ELEMENT_NODE and
+                         (namespaceURI is ANY or
+                          n.namespaceURI == namespaceURI) and
+                         (localName == '*' or n.localName == localName)]
+        if attribute_test is not None and result:
+            test, localName = attribute_test
+            namespaceURI = test.namespace(axes['attribute'], context)
+            result = [n for parent in result
+                      for n in axes['attribute'](parent)
+                      if (namespaceURI is ANY or
+                          n.namespaceURI == namespaceURI) and
+                         (localName == '*' or n.localName == localName)]
+        return result
+    return evaluate
+
 class PredicateList(Expr):
     """A list of predicates.
     
@@ -753,11 +1812,19 @@ class PredicateList(Expr):
     filtered by the predicates.
 
     """
+    type = NODESET
+
     def __init__(self, expr, predicates, axis='child'):
         self.predicates = predicates
         self.expr = expr
         self.axis = axes[axis]
 
+    def __getstate__(self):
+        return axis_state(self)
+
+    def __setstate__(self, state):
+        set_axis_state(self, state)
+
     def evaluate(self, node, pos, size, context):
         result = self.expr.evaluate(node, pos, size, context)
         if not nodesetp(result):
@@ -786,21 +1853,178 @@ class PredicateList(Expr):
 
         return result
 
+    def compile(self):
+        # A constant position can stop walking the axis once it is reached.
+        if [p for p in self.predicates if constant_position(p) is not None]:
+            lazy = self.compile_lazy()
+            if lazy is not None:
+                def evaluate(node, pos, size, context):
+                    return list(lazy(node, pos, size, context))
+                return evaluate
+        expr = self.expr.compile()
+        if self.expr.type != NODESET:
+            expr = converted(expr, predicate_input)
+        filters = [compile_predicate(pred) for pred in self.predicates]
+        if self.axis.reverse:
+            def evaluate(node, pos, size, context):
+                result = expr(node, pos, size, context)[::-1]
+                for filter in filters:
+                    result = filter(result, context)
+                result.reverse()
+                return result
+        else:
+            def evaluate(node, pos, size, context):
+                result = expr(node, pos, size, context)
+                for filter in filters:
+                    result = filter(result, context)
+                return result
+        return evaluate
+
+    def fold(self):
+        self.expr = self.expr.fold()
+        self.predicates = [pred.fold() for pred in self.predicates]
+        return self
+
+    def compile_lazy(self):
+        if self.axis.reverse:
+            return None
+        expr = self.expr.compile_lazy()
+        if expr is None:
+            return None
+        filters = []
+        for pred in self.predicates:
+            position = constant_position(pred)
+            if position is not None:
+                if position == int(position) and position >= 1:
+                    filters.append(lambda nodes, context, position=int(position):
+                                   islice(nodes, position - 1, position))
+                else:
+                    filters.append(lambda nodes, context: iter(()))
+            elif not uses_position(pred):
+                test = pred.compile()
+                filters.append(lambda nodes, context, test=test:
+                               (node for node in nodes
+                                if test(node, 1, 1, context)))
+            else:
+                return None
+        def evaluate(node, pos, size, context):
+            result = expr(node, pos, size, context)
+            for filter in filters:
+                result = filter(result, context)
+            return result
+        return evaluate
+
     def __str__(self):
         s = str(self.expr)
         if '/' in s:
             s = '(%s)' % s
         return s + ''.join(('[%s]' % x for x in self.predicates))
 
+def axis_state(expr):
+    """Return the pickled state of an expression with an axis, which is
+    pickled by name as axis functions are local to make_axes().
+
+    """
+    state = expr.__dict__.copy()
+    state['axis'] = expr.axis.__name__
+    return state
+
+def set_axis_state(expr, state):
+    expr.__dict__.update(state)
+    expr.axis = axes[state['axis']]
+
+def predicate_input(v):
+    if not nodesetp(v):
+        raise XPathTypeError("predicate input is not a node-set")
+    return v
+
+def constant_position(pred):
+    """Return the position selected by a predicate which is a number
+    literal, or None.
+
+    """
+    # The parser wraps primary expressions in a single step path.
+    while isinstance(pred, PathExpr) and len(pred.steps) == 1:
+        pred = pred.steps[0]
+    if isinstance(pred, LiteralExpr) and pred.type == NUMBER:
+        return pred.literal
+    return None
+
+def compile_predicate(pred):
+    """Compile a predicate into a function taking a node-set and a context,
+    and returning the nodes selected by the predicate.
+
+    """
+    # A constant position needs no evaluation at all.
+    position = constant_position(pred)
+    if position is not None:
+        def select(nodes, context):
+            if position == int(position) and 1 <= position <= len(nodes):
+                return [nodes[int(position) - 1]]
+            return []
+        return select
+
+    call = pred
+    while isinstance(call, PathExpr) and len(call.steps) == 1:
+        call = call.steps[0]
+    if isinstance(call, Function) and call.function.vectorized:
+        # The function is called once for the whole node-set.
+        batch = call.compile_batch()
+        def select(nodes, context):
+            match = []
+            for i, node, r in izip(count(1), nodes, batch(nodes, context)):
+                if numberp(r):
+                    if r == i:
+                        match.append(node)
+                elif boolean(r):
+                    match.append(node)
+            return match
+        return select
+
+    test = pred.compile()
+    if pred.type == NUMBER:
+        def select(nodes, context):
+            size = len(nodes)
+            return [node for i, node in izip(count(1), nodes)
+                    if test(node, i, size, context) == i]
+    elif pred.type is not None:
+        # Booleans, strings and node-sets are all true exactly when Python
+        # considers them to be.
+        def select(nodes, context):
+            size = len(nodes)
+            return [node for i, node in izip(count(1), nodes)
+                    if test(node, i, size, context)]
+    else:
+        def select(nodes, context):
+            size = len(nodes)
+            match = []
+            for i, node in izip(count(1), nodes):
+                r = test(node, i, size, context)
+                if numberp(r):
+                    if r == i:
+                        match.append(node)
+                elif boolean(r):
+                    match.append(node)
+            return match
+    return select
+
 class AxisStep(Expr):
     """One step in a location path expression."""
 
+    type = NODESET
+
     def __init__(self, axis, test=None, predicates=None):
         if test is None:
             test = AnyKindTest()
         self.axis = axes[axis]
         self.test = test
 
+    def __getstate__(self):
+        return axis_state(self)
+
+    def __setstate__(self, state):
+        set_axis_state(self, state)
+
     def evaluate(self, node, pos, size, context):
         match = []
         for n in self.axis(node):
@@ -812,6 +2036,85 @@ class AxisStep(Expr):
 
         return match
 
+    def compile(self):
+        axis = self.axis
+        test = self.test
+        reverse = axis.reverse
+        if isinstance(test, AnyKindTest):
+            def evaluate(node, pos, size, context):
+                match = list(axis(node))
+                if reverse:
+                    match.reverse()
+                return match
+        elif (isinstance(test, NameTest) and test.localName != '*' and
+              axis in (axes['descendant'], axes['descendant-or-self'])):
+            walk = self.compile_name_test()
+            or_self = axis is axes['descendant-or-self']
+            def evaluate(node, pos, size, context):
+                if context.name_index:
+                    match = document_index(node).descendants(
+                        node, test.namespace(axis, context), test.localName,
+                        or_self)
+                    if match is not None:
+                        return match
+                return walk(node, pos, size, context)
+        elif isinstance(test, NameTest):
+            evaluate = self.compile_name_test()
+        else:
+            match = test.match
+            def evaluate(node, pos, size, context):
+                result = [n for n in axis(node) if match(n, axis, context)]
+                if reverse:
+                    result.reverse()
+                return result
+        return evaluate
+
+    def compile_lazy(self):
+        if self.axis.reverse:
+            return None
+        axis = self.axis
+        test = self.test
+        if isinstance(test, AnyKindTest):
+            def evaluate(node, pos, size, context):
+                return iter(axis(node))
+        elif isinstance(test, NameTest):
+            indexed = self.compile()
+            index = axis in (axes['descendant'], axes['descendant-or-self'])
+            principal_node_type = axis.principal_node_type
+            localName = test.localName
+            def evaluate(node, pos, size, context):
+                if index and context.name_index:
+                    return iter(indexed(node, pos, size, context))
+                namespaceURI = test.namespace(axis, context)
+                return (n for n in axis(node)
+                        if n.nodeType == principal_node_type and
+                           (namespaceURI is ANY or
+                            n.namespaceURI == namespaceURI) and
+                           (localName == '*' or n.localName == localName))
+        else:
+            match = test.match
+            def evaluate(node, pos, size, context):
+                return (n for n in axis(node) if match(n, axis, context))
+        return evaluate
+
+    def compile_name_test(self):
+        axis = self.axis
+        test = self.test
+        reverse = axis.reverse
+        principal_node_type = axis.principal_node_type
+        localName = test.localName
+        def evaluate(node, pos, size, context):
+            namespaceURI = test.namespace(axis, context)
+            match = [n for n in axis(node)
+                     if n.nodeType == principal_node_type and
+                        (namespaceURI is ANY or
+                         n.namespaceURI == namespaceURI) and
+                        (localName == '*' or n.localName == localName)]
+            if reverse:
+                match.reverse()
+            return match
+        return evaluate
+
     def __str__(self):
         return '%s::%s' % (self.axis.__name__, self.test)
 
@@ -825,6 +2128,9 @@ class Test(object):
     def match(self, node, axis, context):
         """Return True if 'node' matches the test along 'axis'."""
 
+# The namespace of a NameTest matching nodes in any namespace.
+ANY = object()
+
 class NameTest(object):
     def __init__(self, prefix, localpart):
         self.prefix = prefix
@@ -832,6 +2138,19 @@ class NameTest(object):
         if self.prefix == None and self.localName == '*':
             self.prefix = '*'
 
+    def namespace(self, axis, context):
+        """Return the namespace URI matched by the test along 'axis', or ANY."""
+        if self.prefix == '*':
+            return ANY
+        if self.prefix is not None:
+            try:
+                return context.namespaces[self.prefix]
+            except KeyError:
+                raise XPathUnknownPrefixError(self.prefix)
+        elif axis.principal_node_type == xml.dom.Node.ELEMENT_NODE:
+            return context.default_namespace
+        return None
+
     def match(self, node, axis, context):
         if node.nodeType != axis.principal_node_type:
             return False
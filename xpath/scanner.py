@@ -0,0 +1,73 @@
+import re
+
+import xpath.parser
+from xpath.yappsrt import SyntaxError
+
+class XPathScanner(xpath.parser.XPathScanner):
+    """A drop-in replacement for the generated scanner which matches every
+    allowed token pattern with a single regular expression call.
+
+    The generic yapps scanner tries each of its patterns in turn at the
+    current position, keeping the longest match (and the earliest pattern
+    on a tie).  Here the allowed patterns for a restriction are combined
+    into one expression, each pattern in its own optional lookahead group,
+    so one match() reports what every pattern would have matched.  The
+    token chosen, and the errors raised, are the same as the generic
+    scanner's.
+
+    """
+    # Combined matchers, keyed by restriction.
+    _matchers = {}
+
+    def scan(self, restrict):
+        regexp, groups = self._matcher(restrict)
+        while 1:
+            matched = regexp.match(self.input, self.pos).groups()
+            best_match = -1
+            best_pat = None
+            for p, group in groups:
+                text = matched[group]
+                if text is not None and len(text) > best_match:
+                    best_pat = p
+                    best_match = len(text)
+
+            if best_pat is None:
+                msg = "Bad Token"
+                if restrict:
+                    msg = "Trying to find one of " + ", ".join(restrict)
+                raise SyntaxError(self.pos, msg)
+
+            if best_pat not in self.ignore:
+                token = (self.pos, self.pos + best_match, best_pat,
+                         self.input[self.pos:self.pos + best_match])
+                self.pos = self.pos + best_match
+                if not self.tokens or token != self.tokens[-1]:
+                    self.tokens.append(token)
+                    self.restrictions.append(restrict)
+                return
+            else:
+                self.pos = self.pos + best_match
+
+    def _matcher(self, restrict):
+        """Return the combined expression for the patterns allowed by
+        restrict, along with the (terminal, group number) of each one.
+
+        """
+        key = tuple(restrict or ())
+        try:
+            return self._matchers[key]
+        except KeyError:
+            pass
+
+        parts = []
+        groups = []
+        group = 0
+        for p, regexp in self.patterns:
+            if restrict and p not in restrict and p not in self.ignore:
+                continue
+            parts.append('(?:(?=(%s)))?' % regexp.pattern)
+            groups.append((p, group))
+            group += 1 + regexp.groups
+        matcher = (re.compile(''.join(parts)), groups)
+        self._matchers[key] = matcher
+        return matcher
@@ -0,0 +1,355 @@
+"""Streaming evaluation of a forward-only subset of XPath.
+
+A StreamMatcher matches a set of named expressions against the start and
+end events of an ElementTree parse, without building a DOM.  Only
+absolute paths made of these parts can be streamed:
+
+    child and descendant element steps ('/a', '//a', 'descendant::a')
+    name tests, with or without a namespace prefix, and '*'
+    a final attribute step ('/a/@b')
+    predicates testing attributes against literals ('[@b]', "[@b = 'x']",
+      '[@b > 3]', combined with 'and' and 'or') and constant positions
+      ('[2]', child steps only)
+
+Variables bound to strings or numbers when the matcher is built stand for
+those literals ('[@b = $x]', '[$n]').
+
+Anything else raises XPathNotImplementedError when the matcher is built.
+
+"""
+from collections import deque
+import xml.etree.ElementTree as et
+
+import xpath
+from xpath.exceptions import *
+from xpath.expr import (AbsolutePathExpr, AndExpr, AnyKindTest, AxisStep,
+                        EqualityExpr, LiteralExpr, NameTest, OrExpr, PathExpr,
+                        PredicateList, VariableReference, NUMBER, number,
+                        numberp, stringp, axes)
+
+class StreamStep(object):
+    """One element step of a streamed path.
+
+    descendant is True when the step matches any descendant of the element
+    matched by the previous step, not only its children.  Predicates are
+    either functions of the element's attributes or constant positions.
+
+    """
+    def __init__(self, descendant, match, predicates):
+        self.descendant = descendant
+        self.match = match
+        self.predicates = predicates
+
+class StreamPath(object):
+    """A compiled path: its element steps, and the ElementTree name of
+    the attribute it selects, if any.
+
+    """
+    def __init__(self, name, steps, attribute):
+        self.name = name
+        self.steps = steps
+        self.attribute = attribute
+
+def unwrap(expr):
+    # The parser wraps primary expressions in a single step path.
+    while isinstance(expr, PathExpr) and len(expr.steps) == 1:
+        expr = expr.steps[0]
+    return expr
+
+def bind(expr, namespaces, variables):
+    """Unwrap expr, replacing a variable reference with a literal of its
+    value.
+
+    """
+    expr = unwrap(expr)
+    if not isinstance(expr, VariableReference):
+        return expr
+    key = expr.name
+    if expr.prefix is not None:
+        try:
+            key = (namespaces[expr.prefix], expr.name)
+        except KeyError:
+            raise XPathUnknownPrefixError(expr.prefix)
+    try:
+        value = variables[key]
+    except (KeyError, TypeError):
+        raise XPathUnknownVariableError(str(expr))
+    if not (stringp(value) or numberp(value)):
+        raise not_streamable(expr)
+    return LiteralExpr(value)
+
+def not_streamable(expr):
+    return XPathNotImplementedError("can't stream %s" % expr)
+
+def qname(test, namespace):
+    if namespace:
+        return '{%s}%s' % (namespace, test.localName)
+    return test.localName
+
+def compile_name(test, principal, namespaces, default_namespace):
+    """Return a function telling whether an ElementTree tag or attribute
+    name passes a name test.
+
+    """
+    if not isinstance(test, NameTest):
+        return None
+    if test.prefix == '*':
+        return lambda tag: True
+    if test.prefix is not None:
+        try:
+            namespace = namespaces[test.prefix]
+        except KeyError:
+            raise XPathUnknownPrefixError(test.prefix)
+    elif principal:
+        namespace = default_namespace
+    else:
+        namespace = None
+    if test.localName == '*':
+        if namespace:
+            prefix = '{%s}' % namespace
+            return lambda tag: tag.startswith(prefix)
+        return lambda tag: not tag.startswith('{')
+    name = qname(test, namespace)
+    return lambda tag: tag == name
+
+def attribute_name(expr, namespaces):
+    """Return the ElementTree name of the attribute selected by a single
+    attribute step, or None if expr isn't one.
+
+    """
+    expr = unwrap(expr)
+    if (not isinstance(expr, AxisStep) or expr.axis is not axes['attribute']
+        or not isinstance(expr.test, NameTest) or expr.test.prefix == '*'
+        or expr.test.localName == '*'):
+        return None
+    namespace = None
+    if expr.test.prefix is not None:
+        try:
+            namespace = namespaces[expr.test.prefix]
+        except KeyError:
+            raise XPathUnknownPrefixError(expr.test.prefix)
+    return qname(expr.test, namespace)
+
+def compile_test(expr, namespaces, variables):
+    """Compile a predicate into a function of an element's attributes."""
+    expr = unwrap(expr)
+    if isinstance(expr, (AndExpr, OrExpr)):
+        left = compile_test(expr.left, namespaces, variables)
+        right = compile_test(expr.right, namespaces, variables)
+        if isinstance(expr, AndExpr):
+            return lambda attrib: left(attrib) and right(attrib)
+        return lambda attrib: left(attrib) or right(attrib)
+
+    name = attribute_name(expr, namespaces)
+    if name is not None:
+        return lambda attrib: name in attrib
+
+    if isinstance(expr, EqualityExpr):
+        op = EqualityExpr.operators[expr.op]
+        left = bind(expr.left, namespaces, variables)
+        right = bind(expr.right, namespaces, variables)
+        if isinstance(left, LiteralExpr):
+            # Compare with the literal on the right.
+            left, right = right, left
+            op = {'<': EqualityExpr.operators['>'],
+                  '<=': EqualityExpr.operators['>='],
+                  '>': EqualityExpr.operators['<'],
+                  '>=': EqualityExpr.operators['<=']}.get(expr.op, op)
+        name = attribute_name(left, namespaces)
+        if name is not None and isinstance(right, LiteralExpr):
+            literal = right.literal
+            if right.type == NUMBER or expr.op not in ('=', '!='):
+                literal = number(literal)
+                def test(attrib):
+                    return (name in attrib and
+                            op(number(attrib[name]), literal))
+            else:
+                def test(attrib):
+                    return name in attrib and op(attrib[name], literal)
+            return test
+
+    raise not_streamable(expr)
+
+def compile_predicates(predicates, descendant, namespaces, variables):
+    compiled = []
+    for pred in predicates:
+        literal = bind(pred, namespaces, variables)
+        if isinstance(literal, LiteralExpr) and literal.type == NUMBER:
+            if descendant:
+                # Positions along the descendant axis span the whole
+                # subtree, which isn't known until it has closed.
+                raise not_streamable(pred)
+            compiled.append(literal.literal)
+        else:
+            compiled.append(compile_test(pred, namespaces, variables))
+    return compiled
+
+def compile_stream(name, expr, namespaces, default_namespace, variables=None):
+    """Compile an expression into a StreamPath."""
+    if not isinstance(expr, AbsolutePathExpr) or expr.path is None:
+        raise not_streamable(expr)
+    steps = []
+    attribute = None
+    descendant = False
+    path = expr.path.steps
+    for i, step in enumerate(path):
+        predicates = []
+        if isinstance(step, PredicateList):
+            predicates = step.predicates
+            step = step.expr
+        if not isinstance(step, AxisStep):
+            raise not_streamable(expr)
+        last = i == len(path) - 1
+        axis = step.axis
+        if (axis is axes['descendant-or-self'] and not predicates and
+            not last and isinstance(step.test, AnyKindTest)):
+            descendant = True
+            continue
+        if axis is axes['attribute'] and last and steps and not predicates:
+            attribute = attribute_name(step, namespaces)
+            if attribute is not None:
+                break
+        if axis is axes['descendant']:
+            descendant = True
+        elif axis is not axes['child']:
+            raise not_streamable(expr)
+        match = compile_name(step.test, True, namespaces, default_namespace)
+        if match is None:
+            raise not_streamable(expr)
+        steps.append(StreamStep(
+            descendant, match,
+            compile_predicates(predicates, axis is axes['descendant'],
+                               namespaces, variables)))
+        descendant = False
+    if not steps:
+        raise not_streamable(expr)
+    return StreamPath(name, steps, attribute)
+
+class StreamMatcher(object):
+    """Match named expressions against a stream of ElementTree events.
+
+    Feed the matcher with start() and end() for each element of a
+    document, or let iterparse() do it.  A match is an Element, complete
+    once its end event has been seen, or the string value of an attribute.
+    Matches are reported in document order by ready(), as soon as they and
+    every match before them have closed.
+
+    variables maps the names of expressions to dicts of the values of the
+    variables they reference.
+
+    """
+    def __init__(self, expressions, namespaces=None, default_namespace=None,
+                 variables=None):
+        if namespaces is None:
+            namespaces = {}
+        if variables is None:
+            variables = {}
+        self.paths = [compile_stream(name, xpath.XPath.get(expr).expr,
+                                     namespaces, default_namespace,
+                                     variables.get(name))
+                      for name, expr in expressions.items()]
+        self.reset()
+
+    def reset(self):
+        """Start matching a new document."""
+        # One frame per open element, and one for the document: the
+        # (path, step) states its children are tested against, the
+        # position counters of those states, and the matches it closes.
+        self.stack = [(set((path, 0) for path in range(len(self.paths))),
+                       {}, None)]
+        self.matches = deque()
+        self.open_matches = 0
+
+    def start(self, elem):
+        parent, counters = self.stack[-1][:2]
+        active = set()
+        closing = None
+        for state in parent:
+            path, i = state
+            steps = self.paths[path].steps
+            step = steps[i]
+            if step.descendant:
+                active.add(state)
+            if not step.match(elem.tag):
+                continue
+            for j, pred in enumerate(step.predicates):
+                if callable(pred):
+                    if not pred(elem.attrib):
+                        break
+                else:
+                    key = (path, i, j)
+                    position = counters.get(key, 0) + 1
+                    counters[key] = position
+                    if position != pred:
+                        break
+            else:
+                if i + 1 < len(steps):
+                    active.add((path, i + 1))
+                else:
+                    closing = self.found(path, elem, closing)
+        self.stack.append((active, {}, closing))
+
+    def found(self, path, elem, closing):
+        name = self.paths[path].name
+        attribute = self.paths[path].attribute
+        if attribute is None:
+            match = [name, elem, False]
+            self.matches.append(match)
+            if closing is None:
+                closing = []
+                self.open_matches += 1
+            closing.append(match)
+        elif attribute in elem.attrib:
+            self.matches.append([name, unicode(elem.attrib[attribute]), True])
+        return closing
+
+    def end(self, elem):
+        closing = self.stack.pop()[2]
+        if closing is not None:
+            self.open_matches -= 1
+            for match in closing:
+                match[2] = True
+
+    def ready(self):
+        """Remove and return the (name, match) pairs that have closed."""
+        ready = []
+        while self.matches and self.matches[0][2]:
+            name, match, closed = self.matches.popleft()
+            ready.append((name, match))
+        return ready
+
+    def results(self):
+        """Remove the closed matches, and return them as a dictionary of
+        lists keyed by expression name.
+
+        """
+        results = {}
+        for name, match in self.ready():
+            results.setdefault(name, []).append(match)
+        return results
+
+    def iterparse(self, source):
+        """Parse source, a file name or file object, and generate the
+        (name, match) pairs found.  Elements outside every match are
+        cleared as they close, so memory use stays flat.
+
+        """
+        self.reset()
+        for event, elem in et.iterparse(source, ('start', 'end')):
+            if event == 'start':
+                self.start(elem)
+            else:
+                matched = self.stack[-1][2] is not None
+                self.end(elem)
+                if not matched and not self.open_matches:
+                    elem.clear()
+                for pair in self.ready():
+                    yield pair
+
+def iterfind(expr, source, namespaces=None, default_namespace=None,
+             variables=None):
+    """Generate the matches of a single expression in source."""
+    matcher = StreamMatcher({None: expr}, namespaces, default_namespace,
+                            {None: variables})
+    for name, match in matcher.iterparse(source):
+        yield match
@@ -0,0 +1,114 @@
+"""Micro-benchmarks for the xpath package.
+
+    python xpath_bench.py
+
+"""
+import timeit
+from xml.dom import minidom
+
+import xpath
+import xpath.expr
+import xpath.parser
+import xpath.scanner
+
+# Expressions of the kind found in xml_models field definitions.
+EXPRESSIONS = [
+    '/root/items/item/name',
+    '/root/items/item/@id',
+    '//item[@type="a"]/price',
+    '/feed/entry[position() < 10]/title',
+    'count(//item[price > 100])',
+    'sum(/order/line/amount) div count(/order/line)',
+    "/catalog/book[author = 'Smith' and year >= 2000]/title",
+    '//x:entry[x:link/@rel != "self"]/x:id',
+    'string(/root/items/item[last()]/name)',
+    'normalize-space(substring-after(/root/header, ":"))',
+    'ancestor-or-self::*[@lang][1]/@lang',
+    '/root/child::node()[self::text() or self::comment()]',
+    '//a[starts-with(@href, "http")] | //link[@rel = "alternate"]/@href',
+    '-1.5e3 + /values/value[3] * 2 mod 7',
+    'boolean(/response/errors/error)',
+]
+
+def parse(scanner_class, expressions):
+    for s in expressions:
+        xpath.parser.XPath(scanner_class(s)).XPath()
+
+def bench_parse(number=200):
+    """Compare parse throughput of the generic yapps scanner with
+    xpath.scanner.XPathScanner.
+
+    """
+    for name, scanner_class in [('yapps scanner', xpath.parser.XPathScanner),
+                                ('combined scanner', xpath.scanner.XPathScanner)]:
+        seconds = min(timeit.repeat(lambda: parse(scanner_class, EXPRESSIONS),
+                                    number=number, repeat=3))
+        print '%-20s %8.0f expressions/s' % (name, number * len(EXPRESSIONS) / seconds)
+
+def deep_document(depth=500):
+    """A single chain of nested elements."""
+    return minidom.parseString('<a>' * depth + '</a>' * depth)
+
+def wide_document(width=5000):
+    """One element with many children, each holding some text."""
+    return minidom.parseString('<a>%s</a>' % ('<b>text</b>' * width))
+
+def bench_axes(number=10):
+    """Time a full walk of each recursive axis over deep and wide trees."""
+    for name, doc in [('deep', deep_document()), ('wide', wide_document())]:
+        root = doc.documentElement
+        last = root
+        while last.lastChild is not None:
+            last = last.lastChild
+        for axis, node in [('descendant', root), ('descendant-or-self', root),
+                           ('preceding', last), ('following', root.firstChild),
+                           ('ancestor', last)]:
+            walk = xpath.expr.axes[axis]
+            seconds = min(timeit.repeat(lambda: list(walk(node)),
+                                        number=number, repeat=3))
+            print '%-5s %-20s %8.2f ms' % (name, axis, seconds / number * 1000)
+
+# Field expressions evaluated against FIELD_DOCUMENT, as a model would.
+FIELD_EXPRESSIONS = [
+    '/root/items/item[@id="250"]/name',
+    '/root/items/item[@id="250"]/@type',
+    '/root/header',
+    '/root/items/item[last()]/name',
+]
+
+FIELD_DOCUMENT = '<root><header>h</header><items>%s</items></root>' % ''.join(
+    ['<item id="%d" type="t%d"><name>n%d</name><price>%d</price></item>'
+     % (i, i % 3, i, i) for i in range(500)])
+
+def bench_backends(number=20):
+    """Time domify() and find_unique() of each xml_models backend
+    available here.
+
+    """
+    from xml_models import xpath_twister
+    saved = xpath_twister.backend
+    try:
+        for backend in xpath_twister.BACKENDS:
+            try:
+                xpath_twister.set_backend(backend)
+            except ImportError:
+                continue
+            dom = xpath_twister.domify(FIELD_DOCUMENT)
+            seconds = min(timeit.repeat(
+                lambda: xpath_twister.domify(FIELD_DOCUMENT),
+                number=number, repeat=3))
+            print '%-5s %-40s %8.2f ms' % (backend, 'domify',
+                                          seconds / number * 1000)
+            for expr in FIELD_EXPRESSIONS:
+                seconds = min(timeit.repeat(
+                    lambda: xpath_twister.find_unique(dom, expr),
+                    number=number, repeat=3))
+                print '%-5s %-40s %8.2f ms' % (backend, expr,
+                                              seconds / number * 1000)
+    finally:
+        xpath_twister.backend = saved
+
+if __name__ == '__main__':
+    bench_parse()
+    bench_axes()
+    bench_backends()
@@ -0,0 +1,507 @@
+import os
+import shutil
+import tempfile
+import unittest
+from xml.dom import minidom
+import xpath
+from xpath.cache import LRUCache
+import xpath.dom
+import xpath.etree
+import xpath.parser
+import xpath.scanner
+import xpath.stream
+import xpath.yappsrt
+from StringIO import StringIO
+import xml.etree.ElementTree as et
+
+class XPathCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        xpath.XPath._cache.clear()
+
+    def test_lru_cache_evicts_least_recently_used_entry(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEquals(['a', 'c'], cache.keys())
+        self.assertEquals(1, cache.stats()['evictions'])
+
+    def test_deleted_entry_is_dropped(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.delete('a')
+        cache.delete('c')
+        self.assertEquals([('b', 2)], cache.items())
+
+    def test_get_counts_hits_and_misses(self):
+        xpath.XPath.get('/foo/bar')
+        xpath.XPath.get('/foo/bar')
+        xpath.XPath.get('/foo/baz')
+        stats = xpath.XPath.cache_stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(2, stats['misses'])
+        self.assertEquals(2, stats['size'])
+
+    def test_cache_keeps_recently_used_expressions_when_full(self):
+        xpath.XPath.set_cache_size(3)
+        try:
+            for expr in ['/a', '/b', '/c', '/a', '/d']:
+                xpath.XPath.get(expr)
+            self.assertEquals(['/c', '/a', '/d'], xpath.XPath._cache.keys())
+        finally:
+            xpath.XPath.set_cache_size(100)
+
+    def test_warm_compiles_expressions_ahead_of_use(self):
+        xpath.XPath.warm(['/foo/bar', '//baz'])
+        doc = minidom.parseString('<foo><bar>abcd</bar></foo>')
+        self.assertEquals('abcd', xpath.findvalue('/foo/bar', doc))
+        self.assertEquals(1, xpath.XPath.cache_stats()['hits'])
+
+    def test_dumped_cache_loads_without_parsing(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, 'xpath.cache')
+            xpath.XPath.warm(['/foo/bar', '//baz[@id = 1 + 1]/@name', 'count(//foo) > 1'])
+            xpath.XPath.dump_cache(cache_file)
+            xpath.XPath._cache.clear()
+            self.assertEquals(3, xpath.XPath.load_cache(cache_file))
+            self.assertEquals(['/foo/bar', '//baz[@id = 1 + 1]/@name', 'count(//foo) > 1'], xpath.XPath._cache.keys())
+            doc = minidom.parseString('<foo><bar>abcd</bar><baz id="2" name="x"/></foo>')
+            self.assertEquals('abcd', xpath.findvalue('/foo/bar', doc))
+            self.assertEquals('x', xpath.findvalue('//baz[@id = 1 + 1]/@name', doc))
+            self.assertEquals(False, xpath.find('count(//foo) > 1', doc))
+            self.assertEquals(0, xpath.XPath.cache_stats()['misses'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_warmed_expressions_outnumbering_the_cache_are_all_dumped(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, 'xpath.cache')
+            expressions = ['/foo/bar%d' % i for i in range(150)]
+            xpath.XPath.warm(expressions)
+            self.assertEquals(0, xpath.XPath.cache_stats()['evictions'])
+            xpath.XPath.dump_cache(cache_file)
+            xpath.XPath.set_cache_size(100)
+            xpath.XPath._cache.clear()
+            self.assertEquals(150, xpath.XPath.load_cache(cache_file))
+            self.assertEquals(expressions, xpath.XPath._cache.keys())
+        finally:
+            xpath.XPath.set_cache_size(100)
+            shutil.rmtree(directory)
+
+    def test_cache_from_another_version_is_ignored(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, 'xpath.cache')
+            xpath.XPath.warm(['/foo/bar'])
+            xpath.XPath.dump_cache(cache_file)
+            xpath.XPath._cache.clear()
+            version = xpath.expr.AST_VERSION
+            xpath.expr.AST_VERSION = version + 1
+            try:
+                self.assertEquals(0, xpath.XPath.load_cache(cache_file))
+            finally:
+                xpath.expr.AST_VERSION = version
+            self.assertEquals(0, xpath.XPath.load_cache(os.path.join(directory, 'missing')))
+            self.assertEquals(0, len(xpath.XPath._cache))
+        finally:
+            shutil.rmtree(directory)
+
+class XPathCompileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<root><a id="1"><b>x</b><b>y</b></a><a id="2"><b>z</b></a></root>')
+
+    def assertCompiledMatchesEvaluated(self, expr):
+        compiled = xpath.XPath(expr)
+        context = xpath.XPathContext(self.doc)
+        self.assertEquals(compiled.expr.evaluate(self.doc, 1, 1, context), compiled.find(self.doc))
+
+    def test_compiled_expressions_match_tree_walking_evaluation(self):
+        for expr in ['/root/a/b', '//b[2]', '//a[@id = 2]/b', 'count(//b) + 1', '//b[last()] | //a',
+                     'string(//a[b = "y"]/@id)', 'substring(//b, 1, 1) = "x"', '//b[position() > 1 or . = "z"]']:
+            self.assertCompiledMatchesEvaluated(expr)
+
+    def test_child_paths_are_walked_directly(self):
+        self.assertTrue(xpath.expr.is_child_path(xpath.XPath('/root/a/@id').expr.path.steps))
+        self.assertFalse(xpath.expr.is_child_path(xpath.XPath('/root/a[1]/b').expr.path.steps))
+        self.assertFalse(xpath.expr.is_child_path(xpath.XPath('/root//b').expr.path.steps))
+        for expr in ['/root/a/b', '/root/a/@id', '/root/*/b', '/*/a/@*', 'a/b', '/root/c/b']:
+            self.assertCompiledMatchesEvaluated(expr)
+
+    def test_expressions_carry_static_result_types(self):
+        self.assertEquals(xpath.expr.NUMBER, xpath.XPath('count(//b) + 1').expr.type)
+        self.assertEquals(xpath.expr.BOOLEAN, xpath.XPath('//b = "x"').expr.type)
+        self.assertEquals(xpath.expr.NODESET, xpath.XPath('/root/a').expr.type)
+        self.assertEquals(None, xpath.XPath('$foo').expr.type)
+
+    def test_constant_subexpressions_are_folded(self):
+        self.assertEquals('(count(/descendant-or-self::node()/child::b) > 2)', str(xpath.XPath('count(//b) > 1 + 1')))
+        self.assertEquals("'ab1'", str(xpath.XPath("concat('a', 'b', 1)")))
+        self.assertEquals('/descendant-or-self::node()/child::b[2]', str(xpath.XPath('//b[1 + 1]')))
+        self.assertEquals(xpath.expr.BOOLEAN, xpath.XPath('not(1 = 2)').expr.type)
+        self.assertEquals('/descendant-or-self::node()/child::b[false()]', str(xpath.XPath('//b[false() and . = "x"]')))
+        self.assertEquals('(position() = last())', str(xpath.XPath('position() = last()')))
+
+    def test_folded_expressions_match_tree_walking_evaluation(self):
+        for expr in ['//b[1 + 1]', "//a[substring(@code, 1, 3) = concat('A', 'BC')]", '-(2 * 3) + count(//b)',
+                     '//b[position() = 1 + 1]', '//a[@id = number(string(2))]/b', '1 div 0']:
+            self.assertCompiledMatchesEvaluated(expr)
+
+    def test_folding_leaves_errors_to_evaluation(self):
+        self.assertEquals(False, xpath.find('false() and count("a")', self.doc))
+        self.assertRaises(xpath.XPathTypeError, xpath.find, 'count("a")', self.doc)
+
+class XPathContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<root xmlns="urn:d" xmlns:p="urn:p"><p:a>x</p:a><a>y</a></root>')
+
+    def test_document_context_is_discovered_once_per_document(self):
+        context = xpath.document_context(self.doc)
+        self.assertTrue(context is xpath.document_context(self.doc.documentElement.firstChild))
+        self.assertEquals('urn:d', context.default_namespace)
+        self.assertEquals({'p': 'urn:p'}, context.namespaces)
+        self.assertEquals(['x'], xpath.findvalues('/root/p:a', self.doc))
+        xpath.expr.invalidate_index(self.doc)
+        self.assertFalse(context is xpath.document_context(self.doc))
+
+    def test_keyword_arguments_leave_document_context_unchanged(self):
+        self.assertEquals(['y'], xpath.findvalues('/root/q:a', self.doc, namespaces={'q': 'urn:d'}, v=1))
+        context = xpath.document_context(self.doc)
+        self.assertEquals({'p': 'urn:p'}, context.namespaces)
+        self.assertEquals({}, context.variables)
+
+    def test_clone_copies_variables_on_update(self):
+        context = xpath.XPathContext(self.doc, a=1)
+        dup = context.clone()
+        self.assertTrue(dup.namespaces is context.namespaces)
+        dup.update(b=2)
+        self.assertEquals({'a': 1}, context.variables)
+        self.assertEquals({'a': 1, 'b': 2}, dup.variables)
+
+class XPathFunctionTest(unittest.TestCase):
+
+    def setUp(self):
+        xpath.XPath._cache.clear()
+        self.doc = minidom.parseString('<root><item code="ABCD">1</item><item code="ABXY">2</item><item code="XY">3</item></root>')
+
+    def tearDown(self):
+        for name in ['upper', 'prefixed', 'double', 'probe']:
+            xpath.expr.functions.pop(name, None)
+
+    def test_arity_is_checked_when_parsing(self):
+        self.assertRaises(xpath.XPathTypeError, xpath.XPath, 'substring("a")')
+        self.assertRaises(xpath.XPathTypeError, xpath.XPath, 'true(1)')
+        self.assertRaises(xpath.XPathUnknownFunctionError, xpath.XPath, 'upper("a")')
+
+    def test_arguments_are_converted_per_position(self):
+        self.assertEquals(['1', '2'], xpath.findvalues("//item[substring(@code, 1, 2) = 'AB']", self.doc))
+        self.assertEquals(u'BC', xpath.find("substring(//item/@code, '2', 2.4)", self.doc))
+        self.assertEquals(u'', xpath.find("substring('abc', 'x')", self.doc))
+
+    def test_registered_function_is_compiled_like_builtins(self):
+        xpath.register_function('upper', lambda self, node, pos, size, context, s: s.upper(),
+                                1, 1, convert=xpath.expr.string, returns=xpath.expr.STRING, pure=True)
+        self.assertEquals(['3'], xpath.findvalues("//item[upper(@code) = upper('xy')]", self.doc))
+        self.assertEquals("'ABC'", str(xpath.XPath("upper('abc')")))
+        self.assertRaises(ValueError, xpath.register_function, 'concat', lambda *args: None)
+
+    def test_nested_find_with_other_variables_computes_its_own_node_sets(self):
+        doc = minidom.parseString('<a><b k="1">x</b><b k="2">y</b><c>y</c></a>')
+        def probe(self, node, pos, size, context, v):
+            return str(len(xpath.find('/a/c[. = /a/b[@k=$v]]', doc, variables={'v': v})))
+        xpath.register_function('probe', probe, 1, 1, convert=xpath.expr.string,
+                                returns=xpath.expr.STRING)
+        self.assertEquals(u'01', xpath.find('concat(probe("1"), probe("2"))', doc))
+
+    def test_vectorized_function_is_called_once_per_predicate(self):
+        calls = []
+        def prefixed(self, nodes, context, codes, prefixes):
+            calls.append(len(nodes))
+            return [code.startswith(prefix) for code, prefix in zip(codes, prefixes)]
+        xpath.register_function('prefixed', prefixed, 2, 2, convert=xpath.expr.string,
+                                returns=xpath.expr.BOOLEAN, vectorized=True)
+        self.assertEquals(['1', '2'], xpath.findvalues("//item[prefixed(@code, 'AB')]", self.doc))
+        self.assertEquals([3], calls)
+        self.assertEquals(True, xpath.find("prefixed(//item/@code, 'A')", self.doc))
+
+    def test_impure_functions_are_not_folded(self):
+        xpath.register_function('double', lambda self, node, pos, size, context, n: n * 2,
+                                1, 1, convert=xpath.expr.number, returns=xpath.expr.NUMBER)
+        self.assertEquals('double(2)', str(xpath.XPath('double(2)')))
+        self.assertEquals(['2'], xpath.findvalues('//item[double(1)]', self.doc))
+
+class XPathVariableTest(unittest.TestCase):
+
+    def setUp(self):
+        xpath.XPath._cache.clear()
+        self.doc = minidom.parseString('<root><item id="1">a</item><item id="2">b</item><item id="3">c</item></root>')
+
+    def test_prepared_expression_binds_variables_at_each_evaluation(self):
+        item = xpath.XPath('//item[@id = $id]')
+        self.assertEquals(['b'], item.findvalues(self.doc, id='2'))
+        self.assertEquals(['c'], item.findvalues(self.doc, id=3))
+        self.assertEquals(['a'], item.findvalues(self.doc, variables={'id': '1'}))
+        self.assertEquals(['b', 'c'], [n.firstChild.data for n in xpath.iterfind('//item[@id > $low]', self.doc, low=1)])
+
+    def test_expressions_differing_in_bound_values_are_parsed_once(self):
+        for id in ['1', '2', '3', '1']:
+            self.assertEquals(1, len(xpath.find('//item[@id = $id]', self.doc, id=id)))
+        stats = xpath.XPath.cache_stats()
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(1, stats['size'])
+
+    def test_unbound_variable_raises(self):
+        self.assertRaises(xpath.XPathUnknownVariableError, xpath.find, '//item[@id = $id]', self.doc)
+
+class XPathDocumentOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<root><a id="1" b="2"><c/></a><d/></root>')
+
+    def test_index_orders_attributes_between_element_and_children(self):
+        a = self.doc.documentElement.firstChild
+        nodes = [self.doc, self.doc.documentElement, a, a.getAttributeNode('b'),
+                 a.getAttributeNode('id'), a.firstChild, a.nextSibling]
+        orders = [xpath.expr.document_order(n) for n in nodes]
+        self.assertEquals(sorted(orders), orders)
+        self.assertEquals(len(set(orders)), len(orders))
+
+    def test_merge_drops_duplicates_and_keeps_document_order(self):
+        target = xpath.find('//a | //d', self.doc)
+        xpath.expr.merge_into_nodeset(target, xpath.find('//c | //d', self.doc))
+        self.assertEquals(['a', 'c', 'd'], [n.nodeName for n in target])
+
+    def test_invalidated_index_sees_new_nodes(self):
+        xpath.find('//d', self.doc)
+        self.doc.documentElement.insertBefore(self.doc.createElement('e'), None)
+        xpath.expr.invalidate_index(self.doc)
+        self.assertEquals(['a', 'c', 'd', 'e'], [n.nodeName for n in xpath.find('//*[not(*)] | //a', self.doc)])
+
+class XPathNameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<root xmlns:p="urn:p"><a><a><b/></a><p:b/></a><b><a/></b></root>')
+
+    def test_indexed_descendants_match_tree_walk(self):
+        indexed = xpath.XPathContext(self.doc, name_index=True)
+        for expr in ['//a', '//b', '//p:b', '//a//b', '/root/b/descendant::a', '//a/descendant-or-self::a',
+                     '//a[b]', '//b[1]', 'count(//zz)']:
+            self.assertEquals(xpath.find(expr, self.doc, namespaces={'p': 'urn:p'}),
+                              xpath.find(expr, self.doc, context=indexed, namespaces={'p': 'urn:p'}))
+
+    def test_descendant_steps_keep_positional_predicates(self):
+        self.assertEquals(2, len(xpath.find('//b[1]', self.doc)))
+        self.assertEquals(1, len(xpath.find('(//b)[1]', self.doc)))
+
+class XPathAxesTest(unittest.TestCase):
+
+    def test_axes_walk_trees_deeper_than_the_recursion_limit(self):
+        depth = 3000
+        doc = minidom.parseString('<a>' * depth + '</a>' * depth)
+        self.assertEquals(depth, xpath.findvalue('count(//a)', doc))
+        self.assertEquals(depth - 1, xpath.findvalue('count(/a/descendant::a)', doc))
+
+    def test_preceding_is_in_reverse_document_order(self):
+        doc = minidom.parseString('<r><a><b/><c/></a><d><e/></d><f/></r>')
+        f = doc.documentElement.lastChild
+        self.assertEquals(['e', 'd', 'c', 'b', 'a'],
+                          [n.nodeName for n in xpath.expr.axes['preceding'](f)])
+
+class XPathLazyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<r><a n="1"><b/><b/></a><a n="2"><b/><a n="3"/></a></r>')
+
+    def test_iterfind_yields_the_same_nodes_as_find(self):
+        for expr in ['/r/a/b', '//a', '//a/@n', '//a[@n > 1]', '/r/a[2]/b[1]', '//a[2]', '//b | //a', '/r/a[0]']:
+            self.assertEquals(xpath.find(expr, self.doc), list(xpath.iterfind(expr, self.doc)))
+
+    def test_iterfind_stops_at_the_nodes_consumed(self):
+        nodes = xpath.iterfind('//a', self.doc)
+        self.assertEquals(u'1', nodes.next().getAttribute('n'))
+        self.assertEquals(u'3', xpath.findnode('//a[@n > 2]', self.doc).getAttribute('n'))
+        self.assertRaises(xpath.XPathTypeError, xpath.findnode, 'count(//a)', self.doc)
+
+class XPathNodeSetComparisonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<r><i ref="1"/><i ref="2"/><i ref="4"/><d id="2"/><d id="3"/><d id="4"/><e/></r>')
+
+    def test_node_set_equality(self):
+        self.assertEquals([u'2', u'4'], xpath.findvalues('//i[@ref = //d/@id]/@ref', self.doc))
+        self.assertEquals(True, xpath.findvalue('//i/@ref = //d/@id', self.doc))
+        self.assertEquals(False, xpath.findvalue('//i/@ref = //e/@id', self.doc))
+
+    def test_node_set_inequality(self):
+        self.assertEquals(True, xpath.findvalue('//i/@ref != //d/@id', self.doc))
+        self.assertEquals(False, xpath.findvalue('//i[2]/@ref != //d[1]/@id', self.doc))
+        self.assertEquals(False, xpath.findvalue('//i/@ref != //e/@id', self.doc))
+
+class XPathSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<r><a id="1"><b>x</b><b>y</b></a><a id="2"><b>z</b></a></r>')
+
+    def test_find_many_matches_separate_finds(self):
+        exprs = {'a': '/r/a', 'b': '/r/a/b', 'first': '/r/a/b[1]', 'ids': '/r/a/@id', 'all': '//b',
+                 'count': 'count(//b)', 'root': '/', 'relative': 'r/a[@id = 2]/b'}
+        results = xpath.find_many(exprs, self.doc)
+        self.assertEquals(sorted(exprs), sorted(results))
+        for name, expr in exprs.items():
+            self.assertEquals(xpath.find(expr, self.doc), results[name])
+
+    def test_sets_are_compiled_once(self):
+        exprs = {'a': '/r/a', 'b': '/r/a/b'}
+        self.assertTrue(xpath.XPathSet.get(exprs) is xpath.XPathSet.get(dict(exprs)))
+        self.assertEquals(3, len(xpath.find_many(exprs, self.doc, memoize=True)['b']))
+
+class XPathStringValueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = minidom.parseString('<root><a>x<b>y<!--z--></b>z</a><a>w</a></root>')
+
+    def test_string_value_concatenates_descendant_text_in_order(self):
+        self.assertEquals(u'xyzw', xpath.expr.string_value(self.doc))
+        self.assertEquals(u'xyz', xpath.findvalue('/root/a', self.doc))
+
+    def test_memoized_evaluation_reuses_string_values(self):
+        context = xpath.XPathContext(self.doc, memoize=True)
+        self.assertEquals(2, len(xpath.find('//a[. = "w" or . = "xyz"]', self.doc, context=context)))
+        self.assertEquals(None, xpath.expr.evaluation_state.values)
+        self.assertEquals(1, xpath.findvalue('count(//a[. = $v])', self.doc, memoize=True, v='w'))
+
+class XPathDomTest(unittest.TestCase):
+
+    xml = ('<root xmlns="urn:d" xmlns:p="urn:p"><a p:x="1" id="&amp;">one<!--c--></a>'
+           '<?pi data?><p:b/><a id="2">three</a></root>')
+    namespaces = {'x': 'urn:d', 'p': 'urn:p'}
+
+    def test_documents_serialize_like_minidom(self):
+        xml = '<r b="&quot;" a="1">x&lt;y&gt;<z/><?pi data?><!-- c --></r>'
+        self.assertEquals(minidom.parseString(xml).toxml(), xpath.dom.parseString(xml).toxml())
+        self.assertEquals(minidom.parseString(xml).firstChild.toxml(), xpath.dom.parseString(xml).firstChild.toxml())
+
+    def test_expressions_evaluate_like_minidom(self):
+        doc = xpath.dom.parseString(self.xml)
+        other = minidom.parseString(self.xml)
+        for expr in ['/x:root/x:a', '//text()', '//@id', '/x:root/*', 'string(/)', '//node()',
+                     'name(//p:b)', 'local-name(//@p:x)', 'namespace-uri(//p:b)', 'count(/x:root/@*)',
+                     '//x:a[1]/following-sibling::node()', '//x:a[@id = "2"]/preceding::comment()']:
+            result = xpath.find(expr, doc, namespaces=self.namespaces)
+            expected = xpath.find(expr, other, namespaces=self.namespaces)
+            if isinstance(result, list):
+                result = [(node.nodeType, node.nodeName, xpath.expr.string_value(node)) for node in result]
+                expected = [(node.nodeType, node.nodeName, xpath.expr.string_value(node)) for node in expected]
+            self.assertEquals(expected, result)
+
+    def test_character_data_is_merged_into_one_text_node(self):
+        a = xpath.dom.parseString('<a>one<![CDATA[<two>]]>&amp;<!--c--></a>').documentElement
+        self.assertEquals([u'one<two>&', u'c'], [node.data for node in a.childNodes])
+        self.assertEquals(a.lastChild, a.firstChild.nextSibling)
+
+    def test_namespace_declarations_are_attributes(self):
+        context = xpath.XPathContext(xpath.dom.parseString(self.xml))
+        self.assertEquals('urn:d', context.default_namespace)
+        self.assertEquals({'p': 'urn:p'}, context.namespaces)
+
+class XPathElementTreeTest(unittest.TestCase):
+
+    xml = '<r xmlns:p="urn:p"><a id="1">x<b p:k="2">y</b>z</a><a id="2"/>tail</r>'
+
+    def test_adapted_tree_evaluates_like_parsed_document(self):
+        adapted = xpath.etree.adapt(et.fromstring(self.xml))
+        parsed = xpath.dom.parseString(self.xml)
+        for expr in ['//a[@id=2]', '//b/@p:k', 'string(/r)', '//text()', '//b/following::node()', '/r/a[1]/node()[2]',
+                     '//b/ancestor::*', 'count(//@id)']:
+            result = xpath.find(expr, adapted, namespaces={'p': 'urn:p'})
+            expected = xpath.find(expr, parsed, namespaces={'p': 'urn:p'})
+            if isinstance(result, list):
+                result = [xpath.expr.string_value(node) for node in result]
+                expected = [xpath.expr.string_value(node) for node in expected]
+            self.assertEquals(expected, result)
+
+    def test_find_returns_source_elements(self):
+        root = et.fromstring(self.xml)
+        self.assertEquals(root.findall('a'), xpath.etree.find('/r/a', root))
+        self.assertEquals([u'2'], [attr.value for attr in xpath.etree.find('//@p:k', root, namespaces={'p': 'urn:p'})])
+        self.assertEquals(u'y', xpath.etree.find('string(//b)', root))
+
+    def test_compiled_findall_selects_like_the_engine(self):
+        root = et.fromstring(self.xml)
+        document = xpath.etree.adapt(root, keep_elements=True)
+        for expr in ['/r/a', '/r/a[1]', "/r/a[@id='2']", '/r/a[b]', '/r/a/@id', '//b', '//*[@id]', '/r//p:b/@p:k', '.']:
+            findall = xpath.etree.compile_findall(expr, namespaces={'p': 'urn:p'})
+            self.assertNotEqual(None, findall, expr)
+            expected = xpath.find(expr, document, namespaces={'p': 'urn:p'})
+            expected = [xpath.etree.mirrored(node) for node in expected]
+            expected = [getattr(node, 'value', node) for node in expected]
+            if expr == '.':
+                expected = [root]
+            self.assertEquals(expected, findall(root), expr)
+
+    def test_compile_findall_declines_other_expressions(self):
+        for expr in ['//a/b', '/r/a[last()]', '/r/a[@id][1]', '/r/*[1]', '//b/..', 'count(//a)', '/r/a[@id=2]']:
+            self.assertEquals(None, xpath.etree.compile_findall(expr), expr)
+
+class XPathStreamTest(unittest.TestCase):
+
+    xml = ('<root xmlns:p="urn:p"><a id="1"><b x="1">one<b x="2">two</b></b><b>three</b></a>'
+           '<a id="2"><p:b x="1">four</p:b><c><b x="3">five</b></c></a></root>')
+
+    def stream(self, expr):
+        return [getattr(match, 'text', match)
+                for match in xpath.stream.iterfind(expr, StringIO(self.xml), {'p': 'urn:p'})]
+
+    def find(self, expr):
+        doc = minidom.parseString(self.xml)
+        return [getattr(node, 'value', None) or node.firstChild.data
+                for node in xpath.find(expr, doc, namespaces={'p': 'urn:p'})]
+
+    def test_streamed_matches_equal_evaluated_matches(self):
+        for expr in ['/root/a/b', '//b', '//b[@x]', '//b[@x = "1"]', '//b[@x > 1]', '//b[2]',
+                     '/root/a[2]//b', '//p:b', '//b/@x', '/root/a/@id', '/root/*/b[@x and @y or @x < 2]']:
+            self.assertEquals(self.find(expr), self.stream(expr))
+
+    def test_matches_are_reported_once_closed(self):
+        matcher = xpath.stream.StreamMatcher({'b': '//b', 'id': '/root/a/@id'})
+        pairs = list(matcher.iterparse(StringIO(self.xml)))
+        self.assertEquals(['id', 'b', 'b', 'b', 'id', 'b'], [name for name, match in pairs])
+
+    def test_unstreamable_expressions_are_rejected(self):
+        for expr in ['a/b', '/a/..', '/a[b]', '/a[last()]', '//a/text()', 'count(/a)', 'descendant::a[1]']:
+            self.assertRaises(xpath.XPathNotImplementedError, xpath.stream.StreamMatcher, {'a': expr})
+
+    def test_bound_variables_are_streamed_as_literals(self):
+        variables = {'x': '1', 'n': 2}
+        for expr in ['//b[@x = $x]', '/root/a[$n]//b', '//b[@x > $n]']:
+            doc = minidom.parseString(self.xml)
+            found = [node.firstChild.data for node in xpath.find(expr, doc, variables=variables)]
+            streamed = [match.text for match in
+                        xpath.stream.iterfind(expr, StringIO(self.xml), variables=variables)]
+            self.assertEquals(found, streamed)
+        self.assertRaises(xpath.XPathUnknownVariableError, xpath.stream.StreamMatcher, {'b': '//b[@x = $y]'})
+
+class XPathScannerTest(unittest.TestCase):
+
+    def scan(self, scanner_class, expr):
+        scanner = scanner_class(expr)
+        try:
+            xpath.parser.XPath(scanner).XPath()
+        except xpath.yappsrt.SyntaxError, e:
+            return scanner.tokens, e.pos, e.msg
+        return scanner.tokens
+
+    def test_combined_scanner_matches_generic_scanner(self):
+        for expr in ['child::node()', 'node-name', 'a or b and c', 'div div mod', 'foo-bar.baz',
+                     "count(//a:b[c != 'x'])", '-1.5e3 div .5', 'text', 'a b', 'f(a,)', '"unterminated']:
+            self.assertEquals(self.scan(xpath.parser.XPathScanner, expr),
+                              self.scan(xpath.scanner.XPathScanner, expr))
+
+if __name__=='__main__':
+    unittest.main()